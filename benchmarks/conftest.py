@@ -0,0 +1,115 @@
+""" Shared fixtures of the benchmarks (run with: pytest benchmarks) """
+
+import datetime
+import resource
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine.backend.epygram_env import load_epygram
+
+testdatafolder=libfolder / 'testing' / 'testdata'
+
+pgdfile = testdatafolder.joinpath('Const.Clim.09')
+
+
+def _status_bytes(key: str) -> int | None:
+   #memory value of /proc/self/status (Linux), e.g. VmRSS or VmHWM (peak RSS)
+   try:
+      with open('/proc/self/status') as f:
+         for line in f:
+            if line.startswith(f'{key}:'):
+               return int(line.split()[1]) * 1024
+   except OSError:
+      return None
+   return None
+
+
+def _reset_peak_rss() -> bool:
+   #reset the peak RSS to the current RSS (Linux >= 4.0)
+   try:
+      with open('/proc/self/clear_refs', 'w') as f:
+         f.write('5')
+      return True
+   except OSError:
+      return False
+
+
+def measure_peak_rss(func, *args, **kwargs) -> dict:
+   """Peak RSS (bytes) of the process while func runs, and its increase over the RSS before."""
+   if _reset_peak_rss():
+      before = _status_bytes('VmRSS')
+      func(*args, **kwargs)
+      peak = _status_bytes('VmHWM')
+      return {'peak_rss_bytes': peak, 'peak_rss_increase_bytes': peak - before}
+   #the process peak can not be reset, ru_maxrss is in kilobytes on Linux
+   func(*args, **kwargs)
+   return {'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+@pytest.fixture
+def track_rss(benchmark):
+   """Run a stage once outside the timing and store its peak RSS in the benchmark results."""
+   def track(func, *args, **kwargs):
+      benchmark.extra_info.update(measure_peak_rss(func, *args, **kwargs))
+   return track
+
+
+@pytest.fixture(scope='session')
+def synthetic_fa_files(tmp_path_factory) -> list:
+   """Copies of the PGD file with the validities of a forecast (6 lead times)."""
+   if not pgdfile.exists():
+      pytest.skip(f'{pgdfile} is not available')
+   folder = tmp_path_factory.mktemp('synthetic_fa')
+   basis = datetime.datetime(2025, 1, 1)
+   filenames = []
+   for leadtime in range(6):
+      filename = folder / f'ICMSHSYNT+{leadtime:04d}'
+      shutil.copy(pgdfile, filename)
+      r = load_epygram().open(str(filename), 'a', fmt='FA')
+      try:
+         r.modify_validity(basis=basis, term=datetime.timedelta(hours=leadtime))
+      finally:
+         r.close()
+      filenames.append(filename)
+   return filenames
+
+
+@pytest.fixture(scope='session')
+def synthetic_d3file(tmp_path_factory):
+   """An FA file with two 3D fields (10 hybrid levels) and a 2D field on the PGD geometry."""
+   import copy
+   if not pgdfile.exists():
+      pytest.skip(f'{pgdfile} is not available')
+   epygram = load_epygram()
+   nlevels = 10
+   filename = tmp_path_factory.mktemp('synthetic_d3') / 'ICMSHSYNT+0000'
+   pgd = epygram.formats.resource(str(pgdfile), 'r')
+   field = pgd.readfield('SURFZ0.FOIS.G')
+   field.geometry.vcoordinate.grid = {
+      'gridlevels': tuple((i + 1, {'Ai': 1000. * i, 'Bi': i / nlevels})
+                          for i in range(nlevels + 1)),
+      'ABgrid_position': 'flux'}
+   r = epygram.formats.resource(str(filename), 'w', fmt='FA',
+                                geometry=field.geometry, validity=pgd.validity,
+                                cdiden=pgd.cdiden, processtype=pgd.processtype)
+   pgd.close()
+   try:
+      for name in ['TEMPERATURE', 'HUMI.SPECIFI']:
+         for level in range(1, nlevels + 1):
+            crossection = copy.deepcopy(field)
+            crossection.fid['FA'] = f'S{level:03d}{name}'
+            crossection.geometry.vcoordinate.levels = [level]
+            crossection.setdata(field.getdata() + level)
+            r.writefield(crossection, compression={'KNGRIB': 0})
+      r.writefield(field, compression={'KNGRIB': 0})
+   finally:
+      r.close()
+   return filename
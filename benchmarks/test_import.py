@@ -0,0 +1,47 @@
+""" Benchmarks of the import time of the faengine (run with: pytest benchmarks) """
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# budget of the import time of the faengine modules themselves (microseconds)
+IMPORT_BUDGET_US = 100_000
+
+
+def import_times(module: str) -> dict:
+   #self time (microseconds) of every module imported by `import module` (python -X importtime)
+   env = {**os.environ, 'PYTHONPATH': str(libfolder)}
+   result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                           capture_output=True, text=True, env=env, check=True)
+   times = {}
+   for line in result.stderr.splitlines():
+      if not line.startswith('import time:') or 'self [us]' in line:
+         continue
+      selftime, _, name = line[len('import time:'):].split('|')
+      times[name.strip()] = int(selftime)
+   return times
+
+
+def test_import_faengine(benchmark):
+   times = benchmark.pedantic(import_times, args=('faengine',), rounds=3)
+   benchmark.extra_info['import_us'] = sum(times.values())
+
+   #nothing heavy is imported by the package itself
+   assert 'xarray' not in times
+   assert 'epygram' not in times
+
+
+def test_import_engine(benchmark):
+   #the module loaded by the xarray backend entrypoint
+   times = benchmark.pedantic(import_times, args=('faengine.engine',), rounds=3)
+   faengine_us = sum(t for name, t in times.items() if name.startswith('faengine'))
+   benchmark.extra_info['import_us'] = sum(times.values())
+   benchmark.extra_info['faengine_us'] = faengine_us
+
+   #Epygram is initialized when the first file is opened
+   assert 'epygram' not in times
+   assert faengine_us < IMPORT_BUDGET_US
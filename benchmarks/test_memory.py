@@ -0,0 +1,55 @@
+""" Memory benchmarks of the variable construction (run with: pytest benchmarks) """
+
+import sys
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine.backend.epygram_env import load_epygram
+from faengine.engine import epy_H2D_to_variable
+from faengine.settings import defaultsettings, default_units
+
+testdatafolder=libfolder / 'testing' / 'testdata'
+
+pgdfile = testdatafolder.joinpath('Const.Clim.09')
+
+
+def peak_memory(func, **kwargs):
+   #peak of the memory allocated by func (traced by tracemalloc), in bytes
+   tracemalloc.start()
+   try:
+      func(**kwargs)
+      return tracemalloc.get_traced_memory()[1]
+   finally:
+      tracemalloc.stop()
+
+
+@pytest.fixture
+def h2d_field():
+   #Epygram is only imported (and initialized) when the benchmark runs
+   r = load_epygram().open(str(pgdfile), openmode='r', fmt='FA')
+   try:
+      return r.readfield('SURFZ0.FOIS.G')
+   finally:
+      r.close()
+
+
+def test_h2d_variable_peak_memory(benchmark, h2d_field):
+   field = h2d_field
+   kwargs = {'field': field,
+             'create_base_dim': True,
+             'namesettings': defaultsettings,
+             'unitsettings': default_units}
+   peak = peak_memory(epy_H2D_to_variable, **kwargs)
+   benchmark.extra_info['peak_bytes'] = peak
+   benchmark.extra_info['field_bytes'] = field.data.nbytes
+   benchmark(epy_H2D_to_variable, **kwargs)
+
+   #the time dimensions are added as views: the field data is not copied
+   assert peak < field.data.nbytes / 2
@@ -0,0 +1,60 @@
+""" Benchmarks of opening FA files with the FAEngine (run with: pytest benchmarks) """
+
+import pytest
+import sys
+from pathlib import Path
+
+
+import xarray as xr
+
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine import FAEngine
+
+testdatafolder=libfolder / 'testing' / 'testdata'
+
+pgdfile = testdatafolder.joinpath('Const.Clim.09')
+
+
+def test_open_atm_all_fields(benchmark, track_rss, synthetic_d3file):
+   #all fields, including the 3D fields constructed from the CombineLevels resource
+   kwargs = {'filename_or_obj': synthetic_d3file,
+             'engine': FAEngine,
+             'backend_kwargs': {'whitefield_glob': '*'}}
+   track_rss(xr.open_dataset, **kwargs)
+   ds = benchmark(xr.open_dataset, **kwargs)
+   assert ds.attrs['zdim_detected'] == 'True'
+   assert ds['TEMPERATURE'].sizes['z'] == 10
+
+
+def test_open_pgd_all_fields(benchmark, track_rss):
+   kwargs = {'filename_or_obj': pgdfile,
+             'engine': FAEngine,
+             'backend_kwargs': {'whitefield_glob': '*'}}
+   track_rss(xr.open_dataset, **kwargs)
+   ds = benchmark(xr.open_dataset, **kwargs)
+   assert len(ds.data_vars) > 30
+
+
+@pytest.mark.parametrize('whitefield_glob', ['SURFZ0*', 'SURFZ0.FOIS.G'])
+def test_open_pgd_narrow_glob(benchmark, track_rss, whitefield_glob):
+   kwargs = {'filename_or_obj': pgdfile,
+             'engine': FAEngine,
+             'backend_kwargs': {'whitefield_glob': whitefield_glob}}
+   track_rss(xr.open_dataset, **kwargs)
+   ds = benchmark(xr.open_dataset, **kwargs)
+   assert len(ds.data_vars) > 0
+
+
+def test_open_pgd_lazy(benchmark, track_rss):
+   #only the headers are read
+   kwargs = {'filename_or_obj': pgdfile,
+             'engine': FAEngine,
+             'backend_kwargs': {'whitefield_glob': '*', 'lazy_load': True}}
+   track_rss(xr.open_dataset, **kwargs)
+   ds = benchmark(xr.open_dataset, **kwargs)
+   assert len(ds.data_vars) > 30
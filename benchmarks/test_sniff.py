@@ -0,0 +1,28 @@
+""" Benchmarks of the FA file detection of the xarray entrypoint (run with: pytest benchmarks) """
+
+import sys
+from pathlib import Path
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine.engine import FAEngine
+
+testdatafolder=libfolder / 'testing' / 'testdata'
+
+pgdfile = testdatafolder.joinpath('Const.Clim.09')
+
+
+def test_guess_can_open(benchmark):
+   #only the header is read, Epygram is not used
+   assert benchmark(FAEngine().guess_can_open, str(pgdfile))
+   #a few microseconds: xarray plugin detection is not slowed down
+   if benchmark.enabled:
+      benchmark.extra_info['mean_us'] = benchmark.stats.stats.mean * 1e6
+
+
+def test_guess_can_open_other_file(benchmark):
+   #other files (e.g. NetCDF) are rejected from their header
+   assert not benchmark(FAEngine().guess_can_open, str(Path(__file__)))
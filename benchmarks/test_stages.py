@@ -0,0 +1,111 @@
+""" Benchmarks of the stages of the read path (run with: pytest benchmarks) """
+
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine import geometry_cache, open_fa_mfdataset
+from faengine.backend.arrays import open_fa_resource, read_fields
+from faengine.engine import (CombineLevelsIndex, construct_epy_3D,
+                             reduce_artificial_dimensions,
+                             triage_2d_and_3d_fields)
+from faengine.settings import defaultsettings
+
+testdatafolder=libfolder / 'testing' / 'testdata'
+
+pgdfile = testdatafolder.joinpath('Const.Clim.09')
+
+
+# --- Stages ---
+
+def test_construct_epy_3D(benchmark, track_rss, synthetic_d3file):
+   r = open_fa_resource(synthetic_d3file)
+   r.open()
+   _, d3_fields = triage_2d_and_3d_fields(fieldnames=r.listfields())
+   crossections = next(iter(d3_fields.values()))
+   rcl = CombineLevelsIndex(epyresource=r)
+   kwargs = {'targetfieldnames': crossections,
+             'epyresource': r,
+             'epyCLresource': rcl,
+             'getdata': True}
+   try:
+      track_rss(construct_epy_3D, **kwargs)
+      field = benchmark(construct_epy_3D, **kwargs)
+   finally:
+      #also closes the FA resource
+      rcl.close()
+   assert field.data.shape[0] == len(crossections)
+
+
+def test_coordinates_cold_cache(benchmark, track_rss):
+   r = open_fa_resource(pgdfile)
+   r.open()
+
+   def build_coordinates():
+      geometry_cache.clear()
+      return geometry_cache.get_coordinates(epyfield=r, with_latlon=True)
+
+   track_rss(build_coordinates)
+   coords = benchmark(build_coordinates)
+   r.close()
+   geometry_cache.clear()
+   assert coords['lat'].shape == (coords['y'].size, coords['x'].size)
+
+
+def test_read_fields_window(benchmark, track_rss):
+   #small window of an uncompressed field (memory-mapped, without Epygram)
+   kwargs = {'filename': pgdfile,
+             'fieldnames': ['SURFZ0.FOIS.G'],
+             'window': (slice(10, 20), slice(5, 15))}
+   track_rss(read_fields, **kwargs)
+   data = benchmark(read_fields, **kwargs)
+   assert data.shape == (10, 10)
+
+
+def synthetic_dataset(n_vars=200, ny=500, nx=500) -> xr.Dataset:
+   #dataset with the trivial time and vertical dimensions, as built by the engine
+   coordnames = defaultsettings['coordnames']
+   dims = [coordnames['basetime'], coordnames['validtime'], coordnames['zdim'],
+           coordnames['ydim'], coordnames['xdim']]
+   data = np.zeros((1, 1, 1, ny, nx), dtype=np.float32)
+   return xr.Dataset(
+      data_vars={f'VAR{i:03d}': (dims, data) for i in range(n_vars)},
+      coords={coordnames['zdim']: [1],
+              coordnames['validtime']: [np.datetime64('2025-01-01T06')],
+              coordnames['basetime']: [np.datetime64('2025-01-01T00')]},
+      attrs={'validtime': '2025-01-01 06:00:00', 'basedate': '2025-01-01 00:00:00'})
+
+
+def test_reduce_artificial_dimensions(benchmark, track_rss):
+   ds = synthetic_dataset()
+   track_rss(reduce_artificial_dimensions, ds=ds, namesettings=defaultsettings)
+   reduced = benchmark(reduce_artificial_dimensions, ds=ds, namesettings=defaultsettings)
+   assert defaultsettings['coordnames']['zdim'] not in reduced.dims
+
+
+# --- Multi-file opens ---
+
+def test_open_fa_mfdataset(benchmark, track_rss, synthetic_fa_files):
+   kwargs = {'paths': synthetic_fa_files, 'whitefield_glob': 'SURFZ0*'}
+   track_rss(open_fa_mfdataset, **kwargs)
+   ds = benchmark(open_fa_mfdataset, **kwargs)
+   assert ds.sizes[defaultsettings['coordnames']['validtime']] == len(synthetic_fa_files)
+
+
+def test_open_fa_mfdataset_load(benchmark, track_rss, synthetic_fa_files):
+   #open and read one field of all the files
+   def open_and_load():
+      ds = open_fa_mfdataset(paths=synthetic_fa_files, whitefield_glob='SURFZ0.FOIS.G')
+      return ds['SURFZ0.FOIS.G'].values
+
+   track_rss(open_and_load)
+   data = benchmark(open_and_load)
+   assert np.isfinite(data).any()
@@ -0,0 +1,63 @@
+""" Micro-benchmarks of the field triage (run with: pytest benchmarks) """
+
+import sys
+from pathlib import Path
+
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine.engine import _select_fields, find_target_fields, triage_2d_and_3d_fields
+
+
+def synthetic_fieldnames(n_fields=10000, n_levels=90) -> list:
+   #3D fields (S001... crossections) and 2D fields, as in an FA file
+   n_3d_basenames = (n_fields // 2) // n_levels
+   fieldnames = [f'S{level:03d}VAR{i:03d}' for i in range(n_3d_basenames)
+                 for level in range(1, n_levels + 1)]
+   fieldnames += [f'SURF2DFIELD{i:05d}' for i in range(n_fields - len(fieldnames))]
+   return fieldnames
+
+
+def test_triage_10k_fields(benchmark):
+   fieldnames = synthetic_fieldnames(n_fields=10000)
+   d2_fields, d3_fields = benchmark(triage_2d_and_3d_fields, fieldnames=fieldnames)
+   assert len(d2_fields) + sum(len(fields) for fields in d3_fields.values()) == 10000
+
+
+def test_triage_100k_fields(benchmark, track_rss):
+   fieldnames = synthetic_fieldnames(n_fields=100000)
+   track_rss(triage_2d_and_3d_fields, fieldnames=fieldnames)
+   d2_fields, d3_fields = benchmark(triage_2d_and_3d_fields, fieldnames=fieldnames)
+   assert len(d2_fields) + sum(len(fields) for fields in d3_fields.values()) == 100000
+
+
+def test_find_target_fields_100_globs(benchmark):
+   #production-like configs: 100 white and black globs on 5000 fields
+   fieldnames = synthetic_fieldnames(n_fields=5000)
+   kwargs = {'epyresource': None,
+             'whitefield_glob': [f'S0??VAR{i:03d}' for i in range(50)] + [f'SURF2DFIELD{i:02d}*' for i in range(40)],
+             'blackfield_glob': [f'S09?VAR{i:03d}' for i in range(10)],
+             'drop_variables': None,
+             'fieldlist': fieldnames}
+
+   def select():
+      _select_fields.cache_clear()
+      return find_target_fields(**kwargs)
+
+   selected = benchmark(select)
+   assert 0 < len(selected) < len(fieldnames)
+
+
+def test_find_target_fields_cached(benchmark):
+   #repeated open of the same file
+   fieldnames = synthetic_fieldnames(n_fields=5000)
+   kwargs = {'epyresource': None,
+             'whitefield_glob': [f'S0??VAR{i:03d}' for i in range(100)],
+             'blackfield_glob': '',
+             'drop_variables': None,
+             'fieldlist': fieldnames}
+   selected = benchmark(find_target_fields, **kwargs)
+   assert len(selected) == len(find_target_fields(**kwargs))
@@ -1,5 +1,34 @@
 
-from faengine.engine import FAEngine
+import importlib
 
 
-__version__ = 'v0.0.2'
\ No newline at end of file
+# The public objects are imported on first use, so `import faengine` stays
+# cheap (xarray and Epygram are only imported when they are needed).
+_lazy_exports = {
+    'FAEngine': 'faengine.engine',
+    'geometry_cache': 'faengine.backend.cache',
+    'field_cache': 'faengine.backend.cache',
+    'FieldInventory': 'faengine.backend.inventory',
+    'open_fa_mfdataset': 'faengine.mfdataset',
+    'iter_fields': 'faengine.iterators',
+    'iter_timesteps': 'faengine.iterators',
+    'add_profile_hook': 'faengine.backend.profiling',
+    'remove_profile_hook': 'faengine.backend.profiling',
+}
+
+__all__ = list(_lazy_exports)
+
+
+def __getattr__(name):
+    if name in _lazy_exports:
+        value = getattr(importlib.import_module(_lazy_exports[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module 'faengine' has no attribute '{name}'")
+
+
+def __dir__():
+    return sorted([*globals(), *_lazy_exports])
+
+
+__version__ = 'v0.0.2'
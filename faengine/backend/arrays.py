@@ -0,0 +1,692 @@
+""" Lazy array wrappers that read (and decode) FA fields on demand. """
+
+import numpy as np
+from xarray.backends import BackendArray
+from xarray.backends.locks import SerializableLock
+from xarray.core import indexing
+
+from faengine.backend.epygram_env import load_epygram
+from faengine.backend.readers import read_lat_lons, read_raw_field
+
+
+# The FA/LFI Fortran library keeps global state (logical units, buffers), so
+# reading is serialized over all files within a process.
+FA_LOCK = SerializableLock()
+
+
+class FAFieldArray(BackendArray):
+    """
+    Lazy representation of one FA field (H2D) or a stack of FA fields (3D).
+
+    The FA file is only opened, and the field(s) only read and decoded, when
+    the array is indexed. The FA file is closed again after each read, because
+    the FA library limits the number of simultaneously opened files.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    fieldnames : list of str
+        FA fieldnames to read. One name for an H2D field, the sorted
+        cross-section names (S001..., S002...) for a 3D field.
+    shape : tuple of int
+        Shape of the variable, including the (trivial) time dimensions.
+    dtype : numpy.dtype, optional
+        Data type of the decoded field. Default is float64.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain that is extracted directly after decoding,
+        so only the subdomain is kept in memory. Default is None (full grid).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed and the spectral
+        coefficients are returned. Default is True.
+    """
+
+    def __init__(self, filename, fieldnames: list, shape: tuple, dtype=np.float64,
+                 window=None, spectral_transform=True):
+        self.filename = str(filename)
+        self.fieldnames = list(fieldnames)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.window = window
+        self.spectral_transform = spectral_transform
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key,
+            self.shape,
+            indexing.IndexingSupport.BASIC,
+            self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key: tuple) -> np.ndarray:
+        #only the selected levels (crossections) are read
+        fieldnames, shape, key = select_levels(self.fieldnames, self.shape, key)
+        data = read_fields(filename=self.filename,
+                           fieldnames=fieldnames,
+                           window=self.window,
+                           spectral_transform=self.spectral_transform,
+                           dtype=self.dtype)
+        # add the trivial (time) dimensions, memory-mapped fields are only
+        # read (and cast) for the selected part
+        return np.asarray(data.reshape(shape)[key], dtype=self.dtype)
+
+
+class FAMultiFileArray(BackendArray):
+    """
+    Lazy representation of an FA field (or 3D field) over a set of FA files.
+
+    The files are arranged on a (base time, valid time) grid. When indexed,
+    only the files that are selected on the time dimensions are read, one at
+    a time. Cells of the grid without a file are filled with NaN.
+
+    Parameters
+    ----------
+    filenames : np.ndarray
+        2D object array with the paths of the FA files on the (base time,
+        valid time) grid, None where there is no file.
+    fieldnames : list of str
+        FA fieldnames to read in each file (see FAFieldArray).
+    shape : tuple of int
+        Shape of the variable, the first two dimensions are the time
+        dimensions of the filenames grid.
+    dtype : numpy.dtype, optional
+        Data type of the decoded field. Default is float64.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract (see FAFieldArray).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed (see FAFieldArray).
+    """
+
+    def __init__(self, filenames, fieldnames: list, shape: tuple, dtype=np.float64,
+                 window=None, spectral_transform=True):
+        self.filenames = filenames
+        self.fieldnames = list(fieldnames)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.window = window
+        self.spectral_transform = spectral_transform
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key,
+            self.shape,
+            indexing.IndexingSupport.BASIC,
+            self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key: tuple) -> np.ndarray:
+        timekey, fieldkey = key[:2], key[2:]
+        #keep the time dimensions while reading, integer keys are applied at the end
+        gridkey = tuple(slice(k, k + 1) if isinstance(k, (int, np.integer)) else k
+                        for k in timekey)
+        filenames = self.filenames[gridkey]
+        fieldshape = np.empty(self.shape[2:], dtype=bool)[fieldkey].shape
+        #only the selected levels (crossections) are read
+        fieldnames, readshape, fieldkey = select_levels(self.fieldnames, self.shape[2:], fieldkey)
+
+        data = np.full((*filenames.shape, *fieldshape), np.nan, dtype=self.dtype)
+        for gridindex, filename in np.ndenumerate(filenames):
+            if filename is None:
+                continue
+            fielddata = read_fields(filename=filename,
+                                    fieldnames=fieldnames,
+                                    window=self.window,
+                                    spectral_transform=self.spectral_transform,
+                                    dtype=self.dtype)
+            data[gridindex] = fielddata.reshape(readshape)[fieldkey]
+        return data[tuple(0 if isinstance(k, (int, np.integer)) else slice(None)
+                          for k in timekey)]
+
+
+class FALatLonArray(BackendArray):
+    """
+    Lazy representation of the 2D latitude or longitude grid of an FA file.
+
+    Nothing is computed until the array is indexed. The full grid is then
+    taken from the geometry cache (in memory or on disk), or computed and
+    cached when the whole grid is requested. When only a part of the grid is
+    requested and it is not cached, only the gridpoints of that part are
+    projected.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    coord : str
+        'lat' or 'lon'.
+    fingerprint : str
+        The geometry fingerprint (see readers.read_geometry_fingerprint).
+    shape : tuple of int
+        (y, x) shape of the (subdomain) grid.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain of the grid. Default is None (full grid).
+    """
+
+    def __init__(self, filename, coord: str, fingerprint: str, shape: tuple, window=None):
+        self.filename = str(filename)
+        self.coord = coord
+        self.fingerprint = fingerprint
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.float64)
+        self.window = window
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key,
+            self.shape,
+            indexing.IndexingSupport.BASIC,
+            self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key: tuple) -> np.ndarray:
+        # avoid a circular import, the geometry cache uses the arrays module
+        from faengine.backend.cache import geometry_cache
+
+        window = self.window if self.window is not None else (slice(None), slice(None))
+        latlon = geometry_cache.get_latlon(self.fingerprint)
+        if latlon is not None:
+            return _latlon_coord(latlon, self.coord)[window][key]
+
+        #grid indices of the requested part
+        offsets = [0, 0] if self.window is None else [w.start or 0 for w in self.window]
+        yindex, xindex = [offset + np.arange(size)[k]
+                          for offset, size, k in zip(offsets, self.shape, key)]
+        full_grid = self.window is None and np.size(yindex) * np.size(xindex) == np.prod(self.shape)
+        with FA_LOCK:
+            r = open_fa_resource(self.filename)
+            try:
+                r.open()
+                if full_grid:
+                    #compute and cache the grids for all datasets on this geometry
+                    coords = geometry_cache.get_coordinates(epyfield=r, with_latlon=True)
+                    return _latlon_coord((coords['lon'], coords['lat']), self.coord)[key]
+                latlon = read_lat_lons(r, window=(np.atleast_1d(yindex), np.atleast_1d(xindex)))
+            finally:
+                r.close()
+        data = unmask_data(_latlon_coord(latlon, self.coord))
+        #drop the axes that are indexed with an integer
+        return data.reshape(np.shape(yindex) + np.shape(xindex))
+
+
+def select_levels(fieldnames: list, shape: tuple, key: tuple) -> tuple:
+    """
+    Restrict a stack of crossections to the levels that are selected by a key.
+
+    The levels (z) axis is the first axis that is not trivial: the axes
+    before it are (time) dimensions of size 1 and the field (y, x) axes come
+    after it. So the z axis is found even when the number of levels equals
+    the size of a horizontal axis.
+
+    Parameters
+    ----------
+    fieldnames : list of str
+        The FA fieldnames of the crossections (or one H2D fieldname).
+    shape : tuple of int
+        Shape of the stacked data (with the trivial dimensions).
+    key : tuple
+        Basic indexing key (integers and slices) on the stacked data.
+
+    Returns
+    -------
+    tuple
+        The fieldnames to read, the shape of their stacked data and the key
+        to index that data with.
+    """
+    if len(fieldnames) == 1:
+        return fieldnames, shape, key
+    zaxis = next(axis for axis, size in enumerate(shape) if size != 1)
+    if shape[zaxis] != len(fieldnames):
+        raise ValueError(f"the levels axis of shape {shape} does not hold the {len(fieldnames)} crossections")
+    levels = np.arange(len(fieldnames))[key[zaxis]]
+    selected = [fieldnames[i] for i in np.atleast_1d(levels)]
+    if not bool(selected):
+        #nothing to read, index the full stack (an empty selection)
+        return fieldnames, shape, key
+    shape = (*shape[:zaxis], len(selected), *shape[zaxis + 1:])
+    key = (*key[:zaxis], 0 if np.ndim(levels) == 0 else slice(None), *key[zaxis + 1:])
+    return selected, shape, key
+
+
+def preferred_chunks(dims: list, shape: tuple, field_dims: list) -> dict:
+    """
+    Get the preferred chunks of a lazy variable: one chunk per field and time step.
+
+    Every chunk is one FA field (or one level of a 3D field), so a chunk
+    task reads only its own field.
+
+    Parameters
+    ----------
+    dims : list of str
+        Dimensions of the variable.
+    shape : tuple of int
+        Shape of the variable.
+    field_dims : list of str
+        The dimensions of one field (horizontal or spectral), kept whole.
+
+    Returns
+    -------
+    dict
+        The chunk size per dimension, for encoding['preferred_chunks'].
+    """
+    return {dim: (size if dim in field_dims else 1) for dim, size in zip(dims, shape)}
+
+
+def _native(dtype) -> np.dtype:
+    # the dtype in the byte order of the machine (FA files are big-endian)
+    return np.dtype(dtype).newbyteorder('=')
+
+
+def _as_dtype(data, dtype) -> np.ndarray:
+    # cast data, data of the requested (native) type is not copied
+    if dtype is None or data.dtype == np.dtype(dtype):
+        return data
+    return data.astype(dtype)
+
+
+def _latlon_coord(latlon: tuple, coord: str) -> np.ndarray:
+    # the grid of coord from a (lons, lats) tuple
+    return latlon[0] if coord == 'lon' else latlon[1]
+
+
+def read_fields(filename, fieldnames: list, window=None,
+                spectral_transform: bool = True, dtype=None) -> np.ndarray:
+    """
+    Open an FA file, read and decode field(s) and close the file again.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    fieldnames : list of str
+        FA fieldnames to read. Multiple fields (crossections of a 3D field)
+        are stacked along the first axis.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract. Default is None (full grid).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed. Default is True.
+    dtype : numpy.dtype, optional
+        Floating point type to cast the decoded data to (see stack_fields).
+        Default is None (as decoded).
+
+    Returns
+    -------
+    np.ndarray
+        The gridpoint data, with shape (y, x) for a single field and
+        (z, y, x) for multiple fields. A single uncompressed field is returned
+        as a read-only view of the file (see readers.read_raw_field), in the
+        byte order of the file and not cast: only the part that the caller
+        uses is read.
+    """
+    #uncompressed gridpoint fields are memory-mapped, without Epygram
+    layers = [read_raw_field(filename, fieldname, window=window) for fieldname in fieldnames]
+    if all(layer is not None for layer in layers):
+        if len(layers) == 1:
+            return layers[0]
+        data = np.empty((len(layers), *layers[0].shape),
+                        dtype=_native(layers[0].dtype) if dtype is None else dtype)
+        for k, layer in enumerate(layers):
+            data[k] = layer
+        return data
+
+    with FA_LOCK:
+        r = open_fa_resource(filename)
+        try:
+            return stack_fields(epyresource=r, fieldnames=fieldnames, window=window,
+                                spectral_transform=spectral_transform, dtype=dtype)
+        finally:
+            r.close()
+
+
+def open_fa_resource(filename):
+    """
+    Open an FA file (delayed, in read mode) as an Epygram resource.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+
+    Returns
+    -------
+    Epygram resource
+        The FA resource.
+    """
+    epygram = load_epygram()
+    return epygram.open(
+        filename=str(filename),
+        openmode='r',
+        fmt='FA',
+        fmtdelayedopen=True)
+
+
+def stack_fields(epyresource, fieldnames: list, window=None,
+                 spectral_transform: bool = True, dtype=None) -> np.ndarray:
+    """
+    Read and decode field(s) from an opened FA resource.
+
+    Uncompressed gridpoint fields are read from the file directly (see
+    readers.read_raw_field) and copied into memory, in the byte order of the
+    machine. The other fields are read and decoded (and spectral fields
+    transformed) one at a time by Epygram. The levels are written directly
+    into the stacked output array.
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The (FA) Epygram resource object.
+    fieldnames : list of str
+        FA fieldnames to read. Multiple fields (crossections of a 3D field)
+        are stacked along the first axis.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract. Default is None (full grid).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed and their spectral
+        coefficients are returned. Default is True.
+    dtype : numpy.dtype, optional
+        Floating point type of the returned data. Each field is cast when it
+        is decoded (into the stacked output), so no full stack is kept in the
+        decoded type. Default is None (as decoded).
+
+    Returns
+    -------
+    np.ndarray
+        The gridpoint data, with shape (y, x) for a single field and
+        (z, y, x) for multiple fields (or the spectral coefficients).
+    """
+    data = None
+    for k, fieldname in enumerate(fieldnames):
+        layer = read_raw_field(epyresource.filename, fieldname, window=window)
+        if layer is not None and len(fieldnames) == 1:
+            return load_raw_field(layer, dtype)
+        if layer is None:
+            field = epyresource.readfield(fieldname)
+            layer = read_gridpoint_data(field,
+                                        window=window,
+                                        spectral_transform=spectral_transform)
+        if len(fieldnames) == 1:
+            return _as_dtype(layer, dtype)
+        if data is None:
+            data = np.empty((len(fieldnames), *layer.shape),
+                            dtype=_native(layer.dtype) if dtype is None else dtype)
+        data[k] = layer
+    return data
+
+
+def load_raw_field(data, dtype=None) -> np.ndarray:
+    """
+    Copy a memory-mapped field into memory.
+
+    The copy is writeable, in the byte order of the machine and does not
+    depend on the FA file any more (it may be rewritten or removed).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The memory-mapped field (see readers.read_raw_field).
+    dtype : numpy.dtype, optional
+        Floating point type of the copy. Default is None (float64).
+
+    Returns
+    -------
+    np.ndarray
+        The field data in memory.
+    """
+    return np.array(data, dtype=_native(data.dtype) if dtype is None else dtype)
+
+
+def read_gridpoint_data(field, window=None,
+                        spectral_transform: bool = True) -> np.ndarray:
+    """
+    Get the gridpoint values of an Epygram field as a plain numpy array.
+
+    Spectral fields are transformed to gridpoint space (in place, by the
+    sp2gp method of the field), masked values are set to NaN (see
+    unmask_data).
+
+    Parameters
+    ----------
+    field : Epygram field
+        The Epygram field object (with data).
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract. The subdomain is copied, so
+        the full field can be released. Default is None (full grid).
+    spectral_transform : bool, optional
+        If False, the spectral coefficients of a spectral field are returned
+        (the window is not applied). Default is True.
+
+    Returns
+    -------
+    np.ndarray
+        The gridpoint data of the field.
+    """
+    if field.spectral:
+        if not spectral_transform:
+            return np.asarray(field.getdata())
+        field.sp2gp()
+    data = field.data
+    if window is not None:
+        data = data[window].copy()
+    return np.asarray(unmask_data(data))
+
+
+def unmask_data(data, fill_value=np.nan) -> np.ndarray:
+    """
+    Convert (masked) data to a plain numpy array, with one conversion at most.
+
+    Masked values are set to fill_value in the data of the masked array
+    itself (in place, when it is writeable), so no filled copy is made.
+    Only integer data with a NaN fill_value is copied (to float64). When the
+    mask is all False (or absent), the data is returned as is.
+
+    Parameters
+    ----------
+    data : np.ndarray or np.ma.MaskedArray
+        The (decoded) data.
+    fill_value : float, optional
+        The value of the masked elements, e.g. NaN or the CF _FillValue.
+        Default is NaN.
+
+    Returns
+    -------
+    np.ndarray
+        The data without mask.
+    """
+    if not np.ma.isMaskedArray(data):
+        return data
+    mask = np.ma.getmask(data)
+    values = np.ma.getdata(data)
+    if mask is np.ma.nomask or not mask.any():
+        return values
+    if values.dtype.kind != 'f' and np.isnan(fill_value):
+        values = values.astype(np.float64)
+    elif not values.flags.writeable:
+        values = values.copy()
+    np.copyto(values, fill_value, where=mask)
+    return values
+
+
+def decoding_dtype(dtype):
+    """
+    Get the type the data is decoded (and stacked) in, for an output dtype.
+
+    Floating point output types are cast to when decoding. Integer output
+    types are packed from the decoded values (see pack_data), so these are
+    decoded as float64.
+
+    Parameters
+    ----------
+    dtype : numpy.dtype or None
+        The output data type.
+
+    Returns
+    -------
+    numpy.dtype or None
+        The decoding data type, None if the data is kept as decoded.
+    """
+    if dtype is None:
+        return None
+    dtype = np.dtype(dtype)
+    return dtype if dtype.kind == 'f' else np.dtype(np.float64)
+
+
+def cast_data(data, dtype) -> tuple:
+    """
+    Cast decoded data to the output dtype.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The decoded data.
+    dtype : numpy.dtype or None
+        The output data type. Integer types are packed (see pack_data).
+
+    Returns
+    -------
+    tuple
+        The cast data and a dict with the CF packing attributes (empty if the
+        data is not packed).
+    """
+    if dtype is None:
+        return data, {}
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu':
+        return pack_data(data, dtype)
+    return _as_dtype(data, dtype), {}
+
+
+def pack_data(data, dtype) -> tuple:
+    """
+    Pack floating point data into integers, with CF scale_factor and add_offset.
+
+    The range of the data is mapped on the integer range, the lowest integer
+    is reserved as _FillValue for missing (NaN or masked) values. When the
+    data is read with CF decoding (mask_and_scale), the values are unpacked.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        The (floating point) data.
+    dtype : numpy.dtype
+        The integer type to pack in (e.g. int16).
+
+    Returns
+    -------
+    tuple
+        The packed data and a dict with the 'scale_factor', 'add_offset' and
+        '_FillValue' attributes.
+    """
+    info = np.iinfo(dtype)
+    data = unmask_data(data)
+    missing = ~np.isfinite(data)
+    if missing.all():
+        vmin, vmax = 0., 0.
+    else:
+        vmin, vmax = float(np.nanmin(data)), float(np.nanmax(data))
+    nsteps = float(info.max) - float(info.min) - 1 #info.min is the _FillValue
+    scale_factor = (vmax - vmin) / nsteps if vmax > vmin else 1.
+    add_offset = vmin - (float(info.min) + 1.) * scale_factor
+
+    #one temporary float array, reused in place
+    scaled = np.subtract(data, add_offset)
+    scaled /= scale_factor
+    np.rint(scaled, out=scaled)
+    scaled[missing] = info.min
+    packed = scaled.astype(dtype)
+    return packed, {'scale_factor': scale_factor,
+                    'add_offset': add_offset,
+                    '_FillValue': int(info.min)}
+
+
+def lazy_field_data(filename, fieldnames: list, shape: tuple, dtype=np.float64,
+                    window=None, spectral_transform=True):
+    """
+    Wrap the FA field(s) in a lazily indexed array, for use in an xarray Variable.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    fieldnames : list of str
+        FA fieldnames to read (see FAFieldArray).
+    shape : tuple of int
+        Shape of the variable, including the (trivial) time dimensions.
+    dtype : numpy.dtype, optional
+        Data type of the decoded field. Default is float64.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract (see FAFieldArray).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed (see FAFieldArray).
+
+    Returns
+    -------
+    xarray.core.indexing.LazilyIndexedArray
+        Lazy array that reads the field(s) when indexed.
+    """
+    return indexing.LazilyIndexedArray(
+        FAFieldArray(filename=filename,
+                     fieldnames=fieldnames,
+                     shape=shape,
+                     dtype=dtype,
+                     window=window,
+                     spectral_transform=spectral_transform))
+
+
+def lazy_multifile_data(filenames, fieldnames: list, shape: tuple, dtype=np.float64,
+                        window=None, spectral_transform=True):
+    """
+    Wrap an FA field over multiple files in a lazily indexed array.
+
+    Parameters
+    ----------
+    filenames : np.ndarray
+        2D object array with the paths of the FA files on the (base time,
+        valid time) grid (see FAMultiFileArray).
+    fieldnames : list of str
+        FA fieldnames to read in each file (see FAFieldArray).
+    shape : tuple of int
+        Shape of the variable, starting with the two time dimensions.
+    dtype : numpy.dtype, optional
+        Data type of the decoded field. Default is float64.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract (see FAFieldArray).
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed (see FAFieldArray).
+
+    Returns
+    -------
+    xarray.core.indexing.LazilyIndexedArray
+        Lazy array that reads the field(s) from the selected files when indexed.
+    """
+    return indexing.LazilyIndexedArray(
+        FAMultiFileArray(filenames=filenames,
+                         fieldnames=fieldnames,
+                         shape=shape,
+                         dtype=dtype,
+                         window=window,
+                         spectral_transform=spectral_transform))
+
+
+def lazy_latlon_data(filename, fingerprint: str, shape: tuple, window=None) -> tuple:
+    """
+    Wrap the longitude and latitude grids in lazily indexed arrays.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    fingerprint : str
+        The geometry fingerprint (see readers.read_geometry_fingerprint).
+    shape : tuple of int
+        (y, x) shape of the (subdomain) grid.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain of the grid (see FALatLonArray).
+
+    Returns
+    -------
+    tuple of xarray.core.indexing.LazilyIndexedArray
+        The lazy (lons, lats) arrays, computed when indexed.
+    """
+    return tuple(indexing.LazilyIndexedArray(
+                    FALatLonArray(filename=filename,
+                                  coord=coord,
+                                  fingerprint=fingerprint,
+                                  shape=shape,
+                                  window=window))
+                 for coord in ['lon', 'lat'])
@@ -0,0 +1,363 @@
+""" Process-level caches shared between opened FA files. """
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import faengine.backend.readers as readers
+import faengine.backend.formatters as formatters
+from faengine.backend.arrays import unmask_data
+from faengine.backend.inventory import _file_key
+
+
+class GeometryCache:
+    """
+    LRU cache of the coordinates and CRS of FA geometries.
+
+    Files on the same grid (e.g. all lead times of a forecast) share their
+    coordinates, so these are computed once per geometry and reused. The
+    cached arrays are shared between datasets and therefore read-only.
+
+    The 2D latitude and longitude grids can also be stored on disk (one
+    .npz file per geometry), so the projection is computed once per
+    geometry over sessions.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of geometries kept in the cache. Default is 16.
+    cache_dir : str or Path, optional
+        Directory of the on-disk lat/lon cache. Default is None: the
+        FAENGINE_CACHE_DIR environment variable, no on-disk cache if unset.
+    """
+
+    def __init__(self, maxsize: int = 16, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir if cache_dir is not None else os.environ.get('FAENGINE_CACHE_DIR')
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_coordinates(self, epyfield, with_latlon: bool = True) -> dict:
+        """
+        Get the coordinates and CRS of the geometry of an Epygram field or resource.
+
+        Parameters
+        ----------
+        epyfield : Epygram field or resource
+            The Epygram field object, or the FA resource (frame of the file).
+        with_latlon : bool, optional
+            If True, the 2D latitude and longitude arrays are included.
+            Default is True.
+
+        Returns
+        -------
+        dict
+            Dictionary with keys 'x', 'y', 'proj_crs' (WKT string) and, if
+            with_latlon, 'lat' and 'lon'.
+        """
+        key = readers.read_geometry_fingerprint(epyfield)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (not with_latlon or 'lat' in entry):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return dict(entry)
+            self.misses += 1
+
+        if entry is None:
+            x, y = readers.read_xy_dims(epyfield)
+            entry = {'x': _readonly(x),
+                     'y': _readonly(y),
+                     'proj_crs': formatters.fmt_proj(readers.read_proj(epyfield=epyfield))}
+        else:
+            entry = dict(entry)
+        if with_latlon:
+            latlon = self._load_latlon(key)
+            if latlon is None:
+                lons, lats = readers.read_lat_lons(epyfield=epyfield)
+                #masked gridpoints are set to NaN once, for all datasets on this grid
+                latlon = unmask_data(lons), unmask_data(lats)
+                self._save_latlon(key, *latlon)
+            entry['lon'] = _readonly(latlon[0])
+            entry['lat'] = _readonly(latlon[1])
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dict(entry)
+
+    def get_latlon(self, key: str) -> tuple | None:
+        """
+        Get the cached latitude and longitude grids of a geometry, without computing them.
+
+        Parameters
+        ----------
+        key : str
+            The geometry fingerprint (see readers.read_geometry_fingerprint).
+
+        Returns
+        -------
+        tuple of np.ndarray or None
+            The (lons, lats) grids, or None if they are neither in memory nor
+            on disk.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and 'lat' in entry:
+                return entry['lon'], entry['lat']
+        return self._load_latlon(key)
+
+    def info(self) -> dict:
+        """
+        Get the cache statistics.
+
+        Returns
+        -------
+        dict
+            Dictionary with the number of hits, misses, on-disk lat/lon hits,
+            the current size and the maxsize of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'disk_hits': self.disk_hits,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize}
+
+    def clear(self):
+        """Remove all geometries from the cache and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0
+
+    def _latlon_file(self, key: str) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        return Path(self.cache_dir) / f'latlon_{key}.npz'
+
+    def _load_latlon(self, key: str) -> tuple | None:
+        path = self._latlon_file(key)
+        if path is None or not path.exists():
+            return None
+        with np.load(path) as cached:
+            latlon = cached['lon'], cached['lat']
+        with self._lock:
+            self.disk_hits += 1
+        return latlon
+
+    def _save_latlon(self, key: str, lons, lats):
+        path = self._latlon_file(key)
+        if path is None:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        #write to a temporary file first, concurrent readers never see a partial file
+        tmpfile = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npz')
+        np.savez(tmpfile, lon=lons, lat=lats)
+        os.replace(tmpfile, path)
+
+
+class FieldCache:
+    """
+    LRU cache of decoded fields, with a memory budget.
+
+    The decoded (gridpoint) data of a field is keyed on the identity of the
+    FA file (path, size and modification time), the fieldname(s) and the
+    subset (subdomain window, spectral transform and decoding type). A file
+    that is reopened (e.g. with another whitefield_glob) reuses the decoded
+    fields, while a rewritten file gets new keys. The least recently used
+    fields are evicted when the budget is exceeded. The cached arrays are
+    shared between datasets and therefore read-only.
+
+    Optionally, the fields are also stored on disk (one .npy file per key),
+    these files are not evicted.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget in bytes. Default is 0 (the cache is disabled), or the
+        FAENGINE_FIELD_CACHE_MB environment variable.
+    cache_dir : str or Path, optional
+        Directory of the on-disk cache. Default is None (no on-disk cache).
+    """
+
+    def __init__(self, max_bytes: int | None = None, cache_dir=None):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get('FAENGINE_FIELD_CACHE_MB', 0)) * 1e6)
+        self.max_bytes = int(max_bytes)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True if fields are cached (in memory or on disk)."""
+        return self.max_bytes > 0 or self.cache_dir is not None
+
+    def get(self, key: tuple) -> np.ndarray | None:
+        """
+        Get a decoded field from the cache.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the field (see field_key).
+
+        Returns
+        -------
+        np.ndarray or None
+            The (read-only) decoded data, None if the field is not cached.
+        """
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return data
+
+        path = self._field_file(key)
+        if path is not None and path.exists():
+            data = np.load(path)
+            with self._lock:
+                self.hits += 1
+                self.disk_hits += 1
+            self._store(key, _readonly(data))
+            return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: tuple, data: np.ndarray) -> np.ndarray:
+        """
+        Add a decoded field to the cache.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the field (see field_key).
+        data : np.ndarray
+            The decoded data. It is made read-only.
+
+        Returns
+        -------
+        np.ndarray
+            The (read-only) cached data.
+        """
+        data = _readonly(data)
+        path = self._field_file(key)
+        if path is not None and not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            #write to a temporary file first, concurrent readers never see a partial file
+            tmpfile = path.with_name(f'{path.stem}.{os.getpid()}.tmp.npy')
+            np.save(tmpfile, data)
+            os.replace(tmpfile, path)
+        self._store(key, data)
+        return data
+
+    def info(self) -> dict:
+        """
+        Get the cache statistics.
+
+        Returns
+        -------
+        dict
+            Dictionary with the number of hits, misses, on-disk hits,
+            evictions, the hit rate, the number of cached fields, the
+            cached bytes and the memory budget.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'disk_hits': self.disk_hits,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups > 0 else 0.,
+                    'size': len(self._entries),
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def clear(self):
+        """Remove all fields from memory and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0
+            self.evictions = 0
+
+    def _store(self, key: tuple, data: np.ndarray):
+        if data.nbytes > self.max_bytes:
+            #larger than the budget, only kept on disk (if any)
+            return
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = data
+            self.nbytes += data.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def _field_file(self, key: tuple) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return Path(self.cache_dir) / f'field_{digest}.npy'
+
+
+def field_key(filename, fieldnames: list, window=None, spectral_transform: bool = True,
+              dtype=None) -> tuple:
+    """
+    Get the field cache key of decoded field(s) of an FA file.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+    fieldnames : list of str
+        The FA fieldname(s), the crossections of a 3D field.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain. Default is None (full grid).
+    spectral_transform : bool, optional
+        If the spectral fields are transformed. Default is True.
+    dtype : numpy.dtype, optional
+        Decoding type (see arrays.decoding_dtype). Default is None.
+
+    Returns
+    -------
+    tuple
+        The key: the file identity (path, size, modification time), the
+        fieldnames and the subset.
+    """
+    if window is not None:
+        window = tuple((w.start, w.stop, w.step) for w in window)
+    return (*_file_key(filename), tuple(fieldnames), window, bool(spectral_transform),
+            None if dtype is None else np.dtype(dtype).str)
+
+
+def _readonly(array):
+    array.flags.writeable = False
+    return array
+
+
+# The caches shared by all FAEngine opens in this process
+geometry_cache = GeometryCache()
+field_cache = FieldCache()
@@ -0,0 +1,31 @@
+""" Lazy import and initialization of Epygram. """
+
+import threading
+
+
+_lock = threading.Lock()
+_epygram = None
+
+
+def load_epygram():
+    """
+    Import Epygram and initialize its environment, once per process.
+
+    Importing Epygram (and its format libraries) and initializing its
+    environment is slow, so it is deferred until a file is opened. This
+    keeps `import faengine`, xarray plugin discovery and the start of
+    (Dask/multiprocessing) workers fast.
+
+    Returns
+    -------
+    module
+        The initialized epygram module.
+    """
+    global _epygram
+    if _epygram is None:
+        with _lock:
+            if _epygram is None:
+                import epygram
+                epygram.init_env()
+                _epygram = epygram
+    return _epygram
@@ -122,7 +122,7 @@ def fmt_lat_variable(latarray) -> Variable:
     Parameters
     ----------
     latarray : np.ndarray
-        Latitude array.
+        Latitude array, with NaN for the missing gridpoints.
 
     Returns
     -------
@@ -135,7 +135,7 @@ def fmt_lat_variable(latarray) -> Variable:
         'units': 'degrees_north'
     }
     #extra attributes
-    attrs['fill_value'] = latarray.fill_value
+    attrs['fill_value'] = _fill_value(latarray)
 
     return Variable(dims=['y', 'x'],
                     data=latarray,
@@ -148,7 +148,7 @@ def fmt_lon_variable(lonarray) -> Variable:
     Parameters
     ----------
     lonarray : np.ndarray
-        Longitude array.
+        Longitude array, with NaN for the missing gridpoints.
 
     Returns
     -------
@@ -161,13 +161,20 @@ def fmt_lon_variable(lonarray) -> Variable:
         'units': 'degrees_east'
     }
     #extra attributes
-    attrs['fill_value'] = lonarray.fill_value
+    attrs['fill_value'] = _fill_value(lonarray)
 
     return Variable(dims=['y', 'x'],
                     data=lonarray,
                     attrs=fmt_dict_for_attrs(attrs))
 
 
+def _fill_value(array) -> float:
+    # fill value of the missing gridpoints, NaN unless a masked array is passed
+    if np.ma.isMaskedArray(array):
+        return float(array.fill_value)
+    return float('nan')
+
+
 def fmt_validtime_variable(validtime, dimname: str) -> Variable:
     """
     Format a valid time as an xarray Variable.
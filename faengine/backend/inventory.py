@@ -0,0 +1,212 @@
+""" Persistent (on-disk) index of the fields of FA files. """
+
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import faengine.backend.readers as readers
+import faengine.backend.formatters as formatters
+from faengine.backend.arrays import FA_LOCK, open_fa_resource
+
+
+class FieldInventory:
+    """
+    SQLite index of the field inventory of FA files.
+
+    For each FA file, the fieldnames, the 2D/3D triage, the grid shape, the
+    levels, the validity and the geometry fingerprint are stored. An entry is
+    keyed on the (absolute) path and is only used when the size and the
+    modification time of the file are unchanged, so globs can be resolved (and
+    multi-file opens planned) without opening the FA file.
+
+    One index file can be shared by many FA files (a central index for an
+    archive), or be kept next to them.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the SQLite index file. It is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS inventory ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, entry TEXT)')
+
+    def get(self, filename) -> dict | None:
+        """
+        Get the inventory entry of an FA file, without opening the file.
+
+        Parameters
+        ----------
+        filename : str or Path
+            Path to the FA file.
+
+        Returns
+        -------
+        dict or None
+            The inventory entry (see record), or None if the file is not
+            indexed or has changed since it was indexed.
+        """
+        path, size, mtime_ns = _file_key(filename)
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime_ns, entry FROM inventory WHERE path = ?',
+                (path,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[2])
+
+    def record(self, filename, epyresource) -> dict:
+        """
+        Index an FA file from its opened Epygram resource.
+
+        Parameters
+        ----------
+        filename : str or Path
+            Path to the FA file.
+        epyresource : Epygram resource
+            The (FA) Epygram resource object of the file.
+
+        Returns
+        -------
+        dict
+            The inventory entry, with keys 'fieldnames', 'h2d_fields',
+            'd3_fields' (base name: sorted crossections), 'gridshape',
+            'levels', 'validdate', 'basedate' and 'geometry' (fingerprint).
+        """
+        entry = read_inventory_entry(epyresource)
+        self._store(filename, entry)
+        return entry
+
+    def _store(self, filename, entry: dict):
+        path, size, mtime_ns = _file_key(filename)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO inventory VALUES (?, ?, ?, ?)',
+                (path, size, mtime_ns, json.dumps(entry)))
+
+    def lookup(self, filename, epyresource=None) -> dict:
+        """
+        Get the inventory entry of an FA file, and index the file if needed.
+
+        Parameters
+        ----------
+        filename : str or Path
+            Path to the FA file.
+        epyresource : Epygram resource, optional
+            The Epygram resource of the file, used when the file has to be
+            indexed. If None, the file is opened (and closed) when needed.
+
+        Returns
+        -------
+        dict
+            The inventory entry (see record).
+        """
+        entry = self.get(filename)
+        if entry is not None:
+            return entry
+        if epyresource is None:
+            entry = scan_inventory_entry(filename)
+        else:
+            entry = read_inventory_entry(epyresource)
+        self._store(filename, entry)
+        return entry
+
+    def info(self) -> dict:
+        """
+        Get the index statistics.
+
+        Returns
+        -------
+        dict
+            Dictionary with the number of hits, misses and indexed files.
+        """
+        with self._lock:
+            size = self._connection.execute('SELECT COUNT(*) FROM inventory').fetchone()[0]
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': size}
+
+    def clear(self):
+        """Remove all entries from the index and reset the statistics."""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM inventory')
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        """Close the connection to the index file."""
+        self._connection.close()
+
+
+def read_inventory_entry(epyresource) -> dict:
+    """
+    Read the inventory of an FA file from its Epygram resource.
+
+    Only the field index and the frame (geometry and validity) are read.
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The (FA) Epygram resource object.
+
+    Returns
+    -------
+    dict
+        The inventory entry (see FieldInventory.record), with JSON
+        serializable values.
+    """
+    # avoid a circular import, the engine uses the inventory
+    from faengine.engine import triage_2d_and_3d_fields
+
+    fieldnames = list(epyresource.listfields())
+    h2d_fields, d3_fields = triage_2d_and_3d_fields(fieldnames=fieldnames)
+    return {
+        'fieldnames': fieldnames,
+        'h2d_fields': list(h2d_fields.keys()),
+        'd3_fields': d3_fields,
+        'gridshape': [int(n) for n in epyresource.geometry.get_datashape(force_dimZ=1)],
+        'levels': readers.read_z_dim(epyresource).tolist(),
+        'validdate': formatters.fmt_timestamp_to_str(readers.read_validdate(epyfield=epyresource)),
+        'basedate': formatters.fmt_timestamp_to_str(readers.read_basedate(epyfield=epyresource)),
+        'geometry': readers.read_geometry_fingerprint(epyresource)}
+
+
+def scan_inventory_entry(filename) -> dict:
+    """
+    Open an FA file, read its inventory and close the file again.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+
+    Returns
+    -------
+    dict
+        The inventory entry (see FieldInventory.record).
+    """
+    with FA_LOCK:
+        r = open_fa_resource(filename)
+        try:
+            return read_inventory_entry(r)
+        finally:
+            r.close()
+
+
+def _file_key(filename) -> tuple:
+    # path, size and modification time identify the content of a file
+    path = Path(filename).resolve()
+    stat = os.stat(path)
+    return str(path), int(stat.st_size), int(stat.st_mtime_ns)
@@ -0,0 +1,123 @@
+""" Decoding of the fields of one FA file in parallel. """
+
+import logging
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from faengine.backend.arrays import FA_LOCK, open_fa_resource, stack_fields
+
+
+def decode_fields(filename,
+                  tasks: dict,
+                  window=None,
+                  n_workers: int | None = None,
+                  executor=None,
+                  spectral_transform: bool = True,
+                  dtypes: dict | None = None) -> dict:
+    """
+    Read and decode fields of an FA file concurrently.
+
+    The tasks are grouped in batches and every batch opens the FA file on its
+    own. As the FA library is not thread-safe (reads are serialized within a
+    process), a speedup is obtained with a process pool. The own pool starts
+    its workers with the 'spawn' method: forked workers would inherit the FA
+    units that the parent holds open. Spawned workers import the __main__
+    module, so a script has to open the files under an
+    ``if __name__ == '__main__':`` guard. Without it the workers can not
+    start, and the fields are decoded serially (with a warning).
+
+    Parameters
+    ----------
+    filename : str
+        Path to the FA file.
+    tasks : dict
+        Variable names as keys and the list of FA fieldnames to read as values
+        (one name for an H2D field, the crossections for a 3D field).
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain to extract. Default is None (full grid).
+    n_workers : int, optional
+        Number of worker processes of the own pool. With an executor, the
+        number of its workers (to size the batches). Default is None (the
+        number of CPUs).
+    executor : concurrent.futures.Executor, optional
+        Executor to submit the batches to. It is not shut down afterwards.
+        A process pool should not fork (use the 'spawn' or 'forkserver'
+        context) when the caller has FA files open.
+    spectral_transform : bool, optional
+        If False, spectral fields are not transformed. Default is True.
+    dtypes : dict, optional
+        Variable names as keys and the floating point type the workers cast
+        the decoded data to as values, so less data is sent back. Default is
+        None (as decoded).
+
+    Returns
+    -------
+    dict
+        Variable names as keys and the decoded data (np.ndarray) as values,
+        in the order of the tasks. Variables that could not be read map to the
+        raised exception.
+    """
+    names = list(tasks.keys())
+    if not bool(names):
+        return {}
+
+    dtypes = {} if dtypes is None else dtypes
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       mp_context=multiprocessing.get_context('spawn'))
+
+    #a few batches per worker, to balance the load without reopening the file for each field
+    batchsize = max(1, math.ceil(len(names) / (4 * n_workers)))
+    batches = [names[i:i + batchsize] for i in range(0, len(names), batchsize)]
+
+    try:
+        futures = [executor.submit(_decode_batch,
+                                   str(filename),
+                                   [(name, tasks[name], dtypes.get(name, None)) for name in batch],
+                                   window,
+                                   spectral_transform)
+                   for batch in batches]
+        decoded = {}
+        #collect in submission order, so the result order is deterministic
+        for future in futures:
+            decoded.update(future.result())
+    except BrokenProcessPool:
+        if not own_executor:
+            raise
+        logging.warning("The decode workers could not be started, the fields are decoded "
+                        "serially. The workers are spawned: a script that decodes in parallel "
+                        "must open the files under an `if __name__ == '__main__':` guard.")
+        decoded = _decode_batch(str(filename),
+                                [(name, tasks[name], dtypes.get(name, None)) for name in names],
+                                window,
+                                spectral_transform)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    return {name: decoded[name] for name in names}
+
+
+def _decode_batch(filename, batch: list, window, spectral_transform=True) -> dict:
+    # Runs in the worker, the FA file is opened once per batch
+    decoded = {}
+    with FA_LOCK:
+        r = open_fa_resource(filename)
+        try:
+            for name, fieldnames, dtype in batch:
+                try:
+                    decoded[name] = stack_fields(epyresource=r,
+                                                 fieldnames=fieldnames,
+                                                 window=window,
+                                                 spectral_transform=spectral_transform,
+                                                 dtype=dtype)
+                except Exception as e:
+                    decoded[name] = e
+        finally:
+            r.close()
+    return decoded
@@ -0,0 +1,166 @@
+""" Opt-in timing of the stages of open_dataset (profile=True). """
+
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# Functions that are called with the report of every profiled open
+_profile_hooks = []
+_hooks_lock = threading.Lock()
+
+
+class OpenProfile:
+    """
+    Wall time, decoded bytes and field counts of the stages of one open.
+
+    The time is accumulated per stage (e.g. 'epygram_open', 'find_target_fields',
+    'readfield', 'sp2gp') and, for the stages that handle one field, per
+    field.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the opened FA file.
+    """
+
+    def __init__(self, filename):
+        self.filename = str(filename)
+        self.stages = {}
+        self.fields = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, field: str | None = None):
+        """
+        Time a stage (context manager).
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        field : str, optional
+            Fieldname, if the stage handles one field. Default is None.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stage = self.stages.setdefault(name, {'seconds': 0., 'calls': 0})
+            stage['seconds'] += elapsed
+            stage['calls'] += 1
+            if field is not None:
+                fieldstats = self._field(field)
+                fieldstats['seconds'] += elapsed
+                fieldstats['stages'][name] = fieldstats['stages'].get(name, 0.) + elapsed
+
+    def add_bytes(self, field: str, nbytes: int):
+        """
+        Add decoded bytes to a field.
+
+        Parameters
+        ----------
+        field : str
+            Fieldname.
+        nbytes : int
+            Number of decoded bytes.
+        """
+        self._field(field)['bytes'] += int(nbytes)
+
+    def report(self) -> dict:
+        """
+        Get the profile as a (JSON serializable) dict.
+
+        Returns
+        -------
+        dict
+            Dictionary with the 'filename', 'total_seconds', 'n_fields',
+            'bytes_decoded', the 'stages' (seconds and calls per stage) and
+            the 'fields' (seconds, bytes and seconds per stage per field).
+        """
+        return {'filename': self.filename,
+                'total_seconds': time.perf_counter() - self._start,
+                'n_fields': len(self.fields),
+                'bytes_decoded': sum(field['bytes'] for field in self.fields.values()),
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'fields': {name: {**field, 'stages': dict(field['stages'])}
+                           for name, field in self.fields.items()}}
+
+    def _field(self, field: str) -> dict:
+        return self.fields.setdefault(field, {'seconds': 0., 'bytes': 0, 'stages': {}})
+
+
+def profile_stage(profile: OpenProfile | None, name: str, field: str | None = None):
+    """
+    Time a stage if profiling is enabled (context manager).
+
+    Parameters
+    ----------
+    profile : OpenProfile or None
+        The profile of the open, None if profiling is disabled.
+    name : str
+        Name of the stage.
+    field : str, optional
+        Fieldname, if the stage handles one field. Default is None.
+    """
+    if profile is None:
+        return nullcontext()
+    return profile.stage(name, field=field)
+
+
+def add_profile_hook(hook):
+    """
+    Register a function that is called with the report of every profiled open.
+
+    This is the extension point for exporters (e.g. to OpenTelemetry spans
+    or a metrics backend).
+
+    Parameters
+    ----------
+    hook : callable
+        Function with the report dict (see OpenProfile.report) as argument.
+    """
+    with _hooks_lock:
+        _profile_hooks.append(hook)
+
+
+def remove_profile_hook(hook):
+    """
+    Unregister a profile hook (see add_profile_hook).
+
+    Parameters
+    ----------
+    hook : callable
+        The registered function.
+    """
+    with _hooks_lock:
+        _profile_hooks.remove(hook)
+
+
+def emit_profile(profile: OpenProfile) -> dict:
+    """
+    Log the profile of an open and pass its report to the registered hooks.
+
+    Parameters
+    ----------
+    profile : OpenProfile
+        The profile of the open.
+
+    Returns
+    -------
+    dict
+        The report (see OpenProfile.report).
+    """
+    report = profile.report()
+    stages = ', '.join(f"{name}: {stage['seconds']:.3f} s"
+                       for name, stage in sorted(report['stages'].items(),
+                                                 key=lambda item: -item[1]['seconds']))
+    logging.info(f"Opened {report['filename']} in {report['total_seconds']:.3f} s "
+                 f"({report['n_fields']} fields, {report['bytes_decoded'] / 1e6:.1f} MB): {stages}")
+    with _hooks_lock:
+        hooks = list(_profile_hooks)
+    for hook in hooks:
+        hook(report)
+    return report
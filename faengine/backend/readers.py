@@ -1,11 +1,134 @@
 """ Collection of functions to extract data from Epygram objects. """
 
 
+import copy
+import functools
+import hashlib
 import logging
+import os
 import pandas as pd
 import numpy as np
 
 
+# ------------------------------------------
+#    File header
+# ------------------------------------------
+
+# LFI (FA) files start with a header of 8-byte integers: the length of the
+# physical records (in words), the maximum length of the article names (16),
+# two other words and the number of physical records.
+LFI_NAME_LENGTH = 16
+LFI_HEADER_WORDS = 5
+# The article names and the (length, position) of the articles are stored in
+# the second and third physical record, the frame dimensions in the
+# CADRE-DIMENSIONS article (truncation, y, x, ...). Each field starts with two
+# FA words: the compression (KNGRIB) and the spectral flag.
+LFI_NARTICLES_WORD = 5
+LFI_FIELD_HEADER_WORDS = 2
+
+
+def is_fa_file(filename) -> bool:
+    """
+    Check if a file is an FA (LFI) file from its header, without Epygram.
+
+    Only the first words of the file are read: the name length of the LFI
+    header must be 16 and the size of the file must match the number and
+    length of the physical records. Both byte orders are accepted.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the file.
+
+    Returns
+    -------
+    bool
+        True if the file has a valid LFI header.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(8 * LFI_HEADER_WORDS)
+            filesize = os.fstat(f.fileno()).st_size
+    except (OSError, TypeError, ValueError):
+        return False
+    if len(header) < 8 * LFI_HEADER_WORDS:
+        return False
+    return _lfi_byteorder(header, filesize) is not None
+
+
+def read_raw_field(filename, fieldname: str, window=None) -> np.ndarray | None:
+    """
+    Get an uncompressed gridpoint field as a memory-mapped view of the FA file.
+
+    Fields that are stored without compression (KNGRIB=0) are, after two
+    words of FA header, the (y, x) array of 8-byte floats. Such fields carry
+    no mask: missing values are stored (and read by Epygram) as values. These are mapped
+    directly from the file, without Epygram: no data is read (nor copied)
+    until it is used, and a window only touches the pages it covers. The
+    record offsets are read once per file (see read_record_index).
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+    fieldname : str
+        The FA fieldname.
+    window : tuple of slice, optional
+        (y-slice, x-slice) subdomain. Default is None (full grid).
+
+    Returns
+    -------
+    np.ndarray or None
+        Read-only view with shape (y, x), in the byte order of the file. None
+        if the field is compressed, spectral or not found, or if the file
+        can not be read without Epygram.
+    """
+    index = read_record_index(filename)
+    if index is None or fieldname not in index['records']:
+        return None
+    offset, length = index['records'][fieldname]
+    ny, nx = index['gridshape']
+    if length != LFI_FIELD_HEADER_WORDS + ny * nx:
+        #compressed, spectral or not a (rectangular) gridpoint field
+        return None
+    kngrib, spectral = np.memmap(filename, dtype=f'{index["byteorder"]}i8', mode='r',
+                                 offset=8 * offset, shape=(LFI_FIELD_HEADER_WORDS,))
+    if kngrib != 0 or spectral != 0:
+        return None
+    data = np.memmap(filename, dtype=f'{index["byteorder"]}f8', mode='r',
+                     offset=8 * (offset + LFI_FIELD_HEADER_WORDS), shape=(ny, nx))
+    if window is not None:
+        data = data[window]
+    return np.asarray(data)
+
+
+def read_record_index(filename) -> dict | None:
+    """
+    Read the record index of an FA (LFI) file, without Epygram.
+
+    The index is cached per file (path, size and modification time), so the
+    offsets of the records are located once.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+
+    Returns
+    -------
+    dict or None
+        Dictionary with the 'byteorder' ('>' or '<') of the file, the
+        'gridshape' (y, x) of the frame and the 'records': the (offset, length)
+        in 8-byte words of every article (field), by name. None if the file
+        is not an FA file or its index spans multiple records.
+    """
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError, ValueError):
+        return None
+    return _record_index(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+
 # ------------------------------------------
 #    Dimensions
 # ------------------------------------------
@@ -16,8 +139,8 @@ def read_x_dim(epyfield) -> np.ndarray:
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -33,8 +156,8 @@ def read_y_dim(epyfield) -> np.ndarray:
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -44,9 +167,46 @@ def read_y_dim(epyfield) -> np.ndarray:
     yvals = epyfield.geometry._get_grid(indextype='xy')[1][:,0]
     return np.array(yvals)
 
-def read_z_dim(epyresource) -> np.array:
-    levels = epyresource.geometry.vcoordinate.levels
-    return np.array(levels)
+def read_xy_dims(epyfield) -> tuple:
+    """
+    Extract the x- and y-dimension values from an Epygram field.
+
+    The grid is computed only once, in contrast to calling read_x_dim and
+    read_y_dim.
+
+    Parameters
+    ----------
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
+
+    Returns
+    -------
+    tuple of np.ndarray
+        Tuple containing (x, y) arrays.
+    """
+    xgrid, ygrid = epyfield.geometry._get_grid(indextype='xy')
+    return np.array(xgrid[0,:]), np.array(ygrid[:,0])
+
+def read_z_dim(epyresource, levels=None) -> np.array:
+    """
+    Extract the z-dimension values (levels) from an Epygram resource.
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The Epygram resource object.
+    levels : list, optional
+        Subset of the levels to return. Default is None (all levels).
+
+    Returns
+    -------
+    np.ndarray
+        Array of z-dimension values.
+    """
+    zlevels = epyresource.geometry.vcoordinate.levels
+    if levels is not None:
+        zlevels = [level for level in zlevels if level in set(levels)]
+    return np.array(zlevels)
 
 
 # ------------------------------------------
@@ -59,8 +219,8 @@ def read_proj(epyfield) -> 'pyproj.proj.Proj':
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -75,14 +235,43 @@ def read_proj(epyfield) -> 'pyproj.proj.Proj':
     return proj
 
 
+def read_geometry_fingerprint(epyfield) -> str:
+    """
+    Get a fingerprint of the (horizontal) geometry of an Epygram field.
+
+    Fields with the same fingerprint share the same grid, projection and
+    thus coordinates.
+
+    Parameters
+    ----------
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
+
+    Returns
+    -------
+    str
+        Hexadecimal hash of the geometry.
+    """
+    geometry = epyfield.geometry
+    description = (
+        type(geometry).__name__,
+        geometry.name,
+        _canonical(geometry.dimensions),
+        _canonical(geometry.grid),
+        _canonical(getattr(geometry, 'projection', None)),
+        _canonical(geometry.position_on_horizontal_grid),
+        _canonical(geometry.geoid))
+    return hashlib.sha1(repr(description).encode()).hexdigest()
+
+
 def read_grid_details(epyfield) -> dict:
     """
     Get grid dimension details from the Epygram field geometry.
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -91,22 +280,150 @@ def read_grid_details(epyfield) -> dict:
     """
     return epyfield.geometry.dimensions
 
-def read_lat_lons(epyfield):
+def read_lat_lons(epyfield, window=None):
     """
     Get longitude and latitude grids from the Epygram field geometry.
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
+    window : tuple, optional
+        (y-index, x-index) part of the grid to compute, as slices or integer
+        arrays. Only the gridpoints of this part are projected. Default is
+        None (full grid).
 
     Returns
     -------
     tuple of np.ndarray
         Tuple containing (lons, lats) arrays.
     """
-    lons, lats = epyfield.geometry.get_lonlat_grid()
-    return lons, lats
+    if window is None:
+        lons, lats = epyfield.geometry.get_lonlat_grid()
+        return lons, lats
+
+    ny, nx = epyfield.geometry.get_datashape(force_dimZ=1)
+    jj, ii = np.meshgrid(np.arange(ny)[window[0]], np.arange(nx)[window[1]], indexing='ij')
+    lons, lats = epyfield.geometry.ij2ll(ii.ravel(), jj.ravel())
+    return np.asarray(lons).reshape(jj.shape), np.asarray(lats).reshape(jj.shape)
+
+
+# ------------------------------------------
+#    spectral geometry
+# ------------------------------------------
+
+def read_spectral_datasize(epyresource) -> int | None:
+    """
+    Get the number of (real) spectral coefficients of a spectral field.
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The (FA) Epygram resource object.
+
+    Returns
+    -------
+    int or None
+        The size of the spectral data, or None if there is no spectral geometry.
+    """
+    spectral_geometry = epyresource.spectral_geometry
+    if spectral_geometry is None:
+        return None
+    if 'fourier' in spectral_geometry.space:
+        #LAM
+        #the gridpoint dimensions are taken from the dimensions and grid of the frame
+        gpdims = {**epyresource.geometry.dimensions, **epyresource.geometry.grid}
+        return int(spectral_geometry.etrans_inq(gpdims)[1])
+    #global
+    datasize = spectral_geometry.legendre_known_spectraldata_size()
+    if datasize is None:
+        datasize = spectral_geometry.trans_inq(epyresource.geometry.dimensions)[1]
+    return int(datasize) * 2 #complex coefficients
+
+
+# ------------------------------------------
+#    subdomain
+# ------------------------------------------
+
+def read_subdomain_window(epyfield,
+                          bbox=None,
+                          index_window=None,
+                          drop_extension_zone=False,
+                          lons=None,
+                          lats=None):
+    """
+    Get the index window of a subdomain of the grid of an Epygram field.
+
+    All the given constraints are combined (intersected).
+
+    Parameters
+    ----------
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
+    bbox : tuple of float, optional
+        Bounding box as (lon_min, lat_min, lon_max, lat_max) in degrees. The
+        window is the smallest one containing all gridpoints in the box.
+    index_window : dict, optional
+        Index window on the full grid, as {'x': (start, stop), 'y': (start, stop)}
+        (slices are accepted as well). Missing dimensions are not subset.
+    drop_extension_zone : bool, optional
+        If True, the extension zone (E) of a LAM grid is dropped, so only the
+        C+I zone remains. Default is False.
+    lons : np.ndarray, optional
+        2D longitude array of the grid, required for bbox.
+    lats : np.ndarray, optional
+        2D latitude array of the grid, required for bbox.
+
+    Returns
+    -------
+    tuple of slice or None
+        (y-slice, x-slice) on the full grid, or None if no subsetting is
+        requested.
+    """
+    if bbox is None and index_window is None and not drop_extension_zone:
+        return None
+
+    dims = epyfield.geometry.dimensions
+    ystart, ystop = 0, int(dims['Y'])
+    xstart, xstop = 0, int(dims['X'])
+
+    if drop_extension_zone:
+        if epyfield.geometry.grid.get('LAMzone', None) == 'CIE':
+            ystart = int(dims['Y_CIoffset'])
+            ystop = ystart + int(dims['Y_CIzone'])
+            xstart = int(dims['X_CIoffset'])
+            xstop = xstart + int(dims['X_CIzone'])
+        else:
+            logging.warning('There is no extension zone to drop on this grid.')
+
+    if index_window is not None:
+        if not isinstance(index_window, dict):
+            raise TypeError(f'index_window is not a dict but {type(index_window)}')
+        if 'y' in index_window:
+            wstart, wstop = _window_bounds(index_window['y'], int(dims['Y']))
+            ystart, ystop = max(ystart, wstart), min(ystop, wstop)
+        if 'x' in index_window:
+            wstart, wstop = _window_bounds(index_window['x'], int(dims['X']))
+            xstart, xstop = max(xstart, wstart), min(xstop, wstop)
+
+    if bbox is not None:
+        if lons is None or lats is None:
+            raise ValueError('lons and lats are required to subset on a bbox.')
+        lon_min, lat_min, lon_max, lat_max = bbox
+        lons = np.ma.filled(lons, np.nan)
+        lats = np.ma.filled(lats, np.nan)
+        inside = ((lons >= lon_min) & (lons <= lon_max) &
+                  (lats >= lat_min) & (lats <= lat_max))
+        yidx = np.flatnonzero(inside.any(axis=1))
+        xidx = np.flatnonzero(inside.any(axis=0))
+        if yidx.size == 0:
+            raise ValueError(f'No gridpoints are found in the bbox: {bbox}.')
+        ystart, ystop = max(ystart, int(yidx[0])), min(ystop, int(yidx[-1]) + 1)
+        xstart, xstop = max(xstart, int(xidx[0])), min(xstop, int(xidx[-1]) + 1)
+
+    if (ystop <= ystart) or (xstop <= xstart):
+        raise ValueError('The requested subdomain does not contain any gridpoints.')
+    return (slice(ystart, ystop), slice(xstart, xstop))
 
 
 # ------------------------------------------
@@ -119,8 +436,8 @@ def read_basedate(epyfield) -> str:
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -138,8 +455,8 @@ def read_validdate(epyfield) -> str:
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -156,8 +473,8 @@ def read_cumulativeduration(epyfield) -> str:
 
     Parameters
     ----------
-    epyfield : Epygram field
-        The Epygram field object.
+    epyfield : Epygram field or resource
+        The Epygram field object, or the FA resource (frame of the file).
 
     Returns
     -------
@@ -171,14 +488,20 @@ def read_cumulativeduration(epyfield) -> str:
 #    vertical coordinates
 # ------------------------------------------
 
-def read_vertical_attrs(epyresource) -> dict:
+def read_vertical_attrs(epyresource, levels=None) -> dict:
     """
     Get vertical coordinate attributes from the Epygram resource.
 
+    When a subset of levels is given, the levels and the hybrid coefficients
+    are subset accordingly: the coefficients are kept for the half levels
+    bounding the selected levels.
+
     Parameters
     ----------
     epyresource : Epygram resource
         The Epygram resource object.
+    levels : list, optional
+        Subset of the levels. Default is None (all levels).
 
     Returns
     -------
@@ -189,8 +512,12 @@ def read_vertical_attrs(epyresource) -> dict:
     vcoords = epyresource.geometry.vcoordinate
     
     #add levels
+    positions = None #positions of the selected full levels
     try:
         retdict['levels'] = vcoords.levels
+        if levels is not None:
+            positions = [i for i, level in enumerate(retdict['levels']) if level in set(levels)]
+            retdict['levels'] = [retdict['levels'][i] for i in positions]
         retdict['Nlevels'] = len(retdict['levels'])
     except:
         pass
@@ -199,6 +526,11 @@ def read_vertical_attrs(epyresource) -> dict:
     try:
         Ais = [level[1]['Ai'] for level in vcoords.grid['gridlevels']]
         Bis = [level[1]['Bi'] for level in vcoords.grid['gridlevels']]
+        if positions is not None:
+            #half levels above (i) and below (i+1) the selected full levels
+            halflevels = sorted(set(positions) | set(i + 1 for i in positions))
+            Ais = [Ais[i] for i in halflevels]
+            Bis = [Bis[i] for i in halflevels]
 
         retdict['Ai_coef'] = list(Ais)
         retdict['Bi_coef'] = list(Bis)
@@ -242,14 +574,7 @@ def read_h2d_field_attrs(epyfield) -> dict:
     dict
         Dictionary of field attributes.
     """
-    attrs = epyfield.fid
-    # 'generic' is a nested dict, unnest it 
-    if 'generic' in attrs.keys():
-        if isinstance(attrs['generic'], dict):
-            attrs.update(attrs['generic'])
-            del attrs['generic']
-
-    return attrs
+    return _flatten_fid(epyfield.fid)
 
 def read_3d_field_attrs(epyfield) -> dict:
     """
@@ -275,10 +600,184 @@ def read_3d_field_attrs(epyfield) -> dict:
 
 
 
+def read_h2d_header_attrs(fieldheader: dict) -> dict:
+    """
+    Extract and flatten the attributes dictionary from a field header.
+
+    Parameters
+    ----------
+    fieldheader : dict
+        A field header, as returned by read_field_headers.
+
+    Returns
+    -------
+    dict
+        Dictionary of field attributes.
+    """
+    return _flatten_fid(copy.deepcopy(fieldheader['fid']))
+
+def read_3d_header_attrs(fieldheaders: list) -> dict:
+    """
+    Extract the attributes dictionary of a 3D field from the headers of its
+    crossections.
+
+    The attributes are the same as those of the CombineLevels field: the
+    generic fid without the level-specific keys.
+
+    Parameters
+    ----------
+    fieldheaders : list of dict
+        The field headers of the crossections, as returned by read_field_headers.
+
+    Returns
+    -------
+    dict
+        Dictionary of field attributes.
+    """
+    attrs = dict(copy.deepcopy(fieldheaders[0]['fid']['generic']))
+    if len(fieldheaders) > 1:
+        # level info is only kept by CombineLevels for single-level fields
+        attrs.pop('level', None)
+        attrs.pop('scaledValueOfFirstFixedSurface', None)
+    return attrs
+
+
+# ------------------------------------------
+#    field headers
+# ------------------------------------------
+
+def read_field_headers(epyresource, fieldnames: list) -> dict:
+    """
+    Get the metadata of fields from the FA headers, without reading field data.
+
+    Only the field index and the field descriptors (FANION) are read, the
+    shape follows from the geometry of the FA frame (all H2D fields of an FA
+    file share the same grid).
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The (FA) Epygram resource object.
+    fieldnames : list of str
+        The FA fieldnames.
+
+    Returns
+    -------
+    dict
+        Dictionary with fieldnames as keys and a field header as values. A
+        field header is a dict with keys 'fid', 'structure' ('H2D' or 'Misc'),
+        'spectral', 'shape' (gridpoint shape), 'spectral_shape' (shape of the
+        spectral coefficients, None for gridpoint fields) and 'dtype'.
+    """
+    targets = set(fieldnames)
+    fids = {fid['FA']: fid for fid in epyresource.listfields(complete=True)
+            if fid['FA'] in targets}
+    gridshape = tuple(epyresource.geometry.get_datashape(force_dimZ=1))
+    spectralshape = None
+
+    headers = {}
+    for fieldname in fieldnames:
+        structure = epyresource.field_type(fieldname)
+        header = {
+            'fid': fids[fieldname],
+            'structure': structure,
+            'spectral': False,
+            'shape': (),
+            'spectral_shape': None,
+            'dtype': None}
+        if structure == 'H2D':
+            header['spectral'] = bool(epyresource.fieldencoding(fieldname)['spectral'])
+            header['shape'] = gridshape #gridpoint shape, also for spectral fields
+            if header['spectral']:
+                if spectralshape is None:
+                    spectralshape = (read_spectral_datasize(epyresource),)
+                header['spectral_shape'] = spectralshape
+            header['dtype'] = np.dtype(np.float64) #FA reals
+        headers[fieldname] = header
+    return headers
+
+
 # ------------------------------------------
 #    helpers
 # ------------------------------------------
 
+def _lfi_byteorder(header: bytes, filesize: int) -> str | None:
+    # byte order of a valid LFI header ('>' or '<'), None if not valid
+    for byteorder in ['>', '<']:
+        words = np.frombuffer(header[:8 * LFI_HEADER_WORDS], dtype=f'{byteorder}i8')
+        reclength, namelength, nrecords = int(words[0]), int(words[1]), int(words[4])
+        if (namelength == LFI_NAME_LENGTH and reclength > 0 and nrecords > 0
+                and 8 * reclength * nrecords == filesize):
+            return byteorder
+    return None
+
+@functools.lru_cache(maxsize=128)
+def _record_index(path: str, size: int, mtime_ns: int) -> dict | None:
+    # size and mtime_ns are part of the cache key, a rewritten file is reread
+    with open(path, 'rb') as f:
+        header = f.read(8 * (LFI_NARTICLES_WORD + 1))
+        if len(header) < 8 * (LFI_NARTICLES_WORD + 1):
+            return None
+        byteorder = _lfi_byteorder(header, size)
+        if byteorder is None:
+            return None
+        words = np.frombuffer(header, dtype=f'{byteorder}i8')
+        reclength, narticles = int(words[0]), int(words[LFI_NARTICLES_WORD])
+        if narticles > 8 * reclength // LFI_NAME_LENGTH:
+            return None
+        f.seek(8 * reclength)
+        names = f.read(narticles * LFI_NAME_LENGTH)
+        f.seek(2 * 8 * reclength)
+        addresses = np.frombuffer(f.read(16 * narticles), dtype=f'{byteorder}i8')
+
+    records = {}
+    for k in range(narticles):
+        name = names[k * LFI_NAME_LENGTH:(k + 1) * LFI_NAME_LENGTH].decode('ascii', 'replace').strip()
+        length, position = int(addresses[2 * k]), int(addresses[2 * k + 1])
+        if position < 1 or 8 * (position - 1 + length) > size:
+            return None
+        #positions are 1-based
+        records[name] = (position - 1, length)
+    if 'CADRE-DIMENSIONS' not in records:
+        return None
+    offset = records['CADRE-DIMENSIONS'][0]
+    dims = np.memmap(path, dtype=f'{byteorder}i8', mode='r', offset=8 * offset, shape=(3,))
+    return {'byteorder': byteorder,
+            'gridshape': (int(dims[1]), int(dims[2])),
+            'records': records}
+
+def _canonical(obj):
+    # Convert (nested) geometry descriptions to hashable, plain python objects
+    if isinstance(obj, dict):
+        return tuple(sorted((str(k), _canonical(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_canonical(v) for v in obj)
+    if isinstance(obj, np.ndarray):
+        return tuple(obj.ravel().tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if type(obj).__name__ == 'Angle':
+        return ('Angle', float(obj.get('degrees')))
+    return obj if isinstance(obj, (int, float, str, bool, type(None))) else repr(obj)
+
+def _window_bounds(window, size: int) -> tuple:
+    if isinstance(window, slice):
+        if window.step not in (None, 1):
+            raise ValueError(f'Only contiguous index windows are supported, not {window}')
+        start, stop, _ = window.indices(size)
+    else:
+        start, stop = window
+        start, stop, _ = slice(start, stop).indices(size)
+    return start, stop
+
+def _flatten_fid(fid: dict) -> dict:
+    # 'generic' is a nested dict, unnest it 
+    if 'generic' in fid.keys():
+        if isinstance(fid['generic'], dict):
+            fid.update(fid['generic'])
+            del fid['generic']
+    return fid
+
 def _check_timestamp(timestamp) -> pd.Timestamp:
     timestamp = pd.Timestamp(timestamp)
     if timestamp.year == 1:
@@ -0,0 +1,287 @@
+""" Conversion of FA files to Zarr or NetCDF. """
+
+import argparse
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from faengine.backend.inventory import FieldInventory
+from faengine.engine import FAEngine, merge_name_settings
+from faengine.iterators import sort_by_validity
+
+
+# Attribute of the Zarr store with the valid times that are completely written
+COMPLETED_ATTR = 'faengine_completed_validtimes'
+
+
+def convert(paths,
+            output,
+            fmt=None,
+            chunks=None,
+            n_workers=None,
+            resume=True,
+            inventory=None,
+            **kwargs) -> dict:
+    """
+    Convert FA files to a Zarr store or to NetCDF files, one file at a time.
+
+    The FA files are converted in the order of their validity, each file is
+    one timestep along the valid time dimension (the base time is kept as a
+    coordinate along the valid time). The fields of a file can be decoded in
+    parallel (n_workers), the timesteps are written one after the other: the
+    output is not written in parallel.
+
+    * Zarr: all files are appended (along time) to one store. When the store
+      exists, the valid times that are already written are skipped, so new
+      forecasts can be appended and an interrupted conversion is resumed.
+    * NetCDF: every FA file is written to its own NetCDF file in the output
+      directory. Existing NetCDF files are skipped when resuming.
+
+    Parameters
+    ----------
+    paths : str or list
+        Glob expression of the FA files, or a list of paths.
+    output : str or Path
+        Path to the Zarr store, or to the output directory for NetCDF.
+    fmt : str, optional
+        'zarr' or 'netcdf'. Default is None: 'zarr' if the output ends on
+        '.zarr', else 'netcdf'.
+    chunks : dict, optional
+        Chunk size per dimension (e.g. {'t': 1, 'z': 10, 'y': 256, 'x': 256}).
+        Default is None (one chunk per timestep and field).
+    n_workers : int, optional
+        If larger than 1, the fields of each file are read and decoded in
+        parallel with this number of processes. Default is None (the fields
+        are read one at a time, while writing).
+    resume : bool, optional
+        If True, skip the timesteps (files) that are already written. If False,
+        the output is overwritten. Default is True.
+    inventory : FieldInventory or str, optional
+        Inventory (or path to its index file) to get the validity and field
+        list of indexed files without listing them. Default is None.
+    **kwargs
+        Other arguments of FAEngine.open_dataset.
+
+    Returns
+    -------
+    dict
+        Conversion statistics: number of converted and skipped files, number
+        of fields, bytes, seconds, 'MB/s' and 'fields/s'.
+    """
+    if fmt is None:
+        fmt = 'zarr' if str(output).rstrip('/').endswith('.zarr') else 'netcdf'
+    if fmt not in ['zarr', 'netcdf']:
+        raise ValueError(f'fmt must be zarr or netcdf, not {fmt}')
+    if inventory is not None and not isinstance(inventory, FieldInventory):
+        inventory = FieldInventory(inventory)
+    coordnames = merge_name_settings(kwargs.get('custom_name_settings', {}))['coordnames']
+
+    stats = {'files': 0, 'skipped': 0, 'fields': 0, 'bytes': 0}
+    start = time.perf_counter()
+    if fmt == 'zarr':
+        #the written valid times are read once, and kept up to date in memory
+        zarrtimes = _zarr_validtimes(output, coordnames=coordnames) if resume else None
+    else:
+        Path(output).mkdir(parents=True, exist_ok=True)
+
+    for filename, entry in sort_by_validity(paths, inventory=inventory):
+        #skip the converted files, before opening them
+        if fmt == 'netcdf':
+            target = Path(output) / f'{Path(filename).name}.nc'
+            done = target.exists()
+        else:
+            done = (zarrtimes is not None
+                    and pd.Timestamp(entry['validdate']).isoformat() in zarrtimes['completed'])
+        if resume and done:
+            stats['skipped'] += 1
+            continue
+
+        ds = open_timestep(filename, coordnames=coordnames, n_workers=n_workers,
+                           inventory=inventory, **kwargs)
+        if fmt == 'zarr':
+            zarrtimes = _write_zarr_timestep(ds, output, chunks=chunks,
+                                             coordnames=coordnames, zarrtimes=zarrtimes)
+        else:
+            _write_netcdf(ds, target, chunks=chunks)
+
+        stats['files'] += 1
+        stats['fields'] += count_fields(ds, coordnames=coordnames)
+        stats['bytes'] += int(sum(ds[name].nbytes for name in ds.data_vars))
+        logging.info(f'Converted {filename} ({stats["files"]} files)')
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['MB/s'] = stats['bytes'] / 1e6 / stats['seconds'] if stats['seconds'] > 0 else 0.
+    stats['fields/s'] = stats['fields'] / stats['seconds'] if stats['seconds'] > 0 else 0.
+    logging.info(f"Converted {stats['files']} files ({stats['skipped']} skipped): "
+                 f"{stats['MB/s']:.1f} MB/s, {stats['fields/s']:.1f} fields/s")
+    return stats
+
+
+def open_timestep(filename, coordnames: dict, n_workers=None, **kwargs) -> xr.Dataset:
+    """
+    Open an FA file as one timestep, for appending along the valid time.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+    coordnames : dict
+        The coordinate names (see settings).
+    n_workers : int, optional
+        Number of processes to decode the fields with (see
+        FAEngine.open_dataset). If None or 1, the dataset is opened lazily.
+    **kwargs
+        Other arguments of FAEngine.open_dataset.
+
+    Returns
+    -------
+    xarray.Dataset
+        Dataset with a valid time dimension of length 1 and the base time as
+        a coordinate along the valid time.
+    """
+    validtime, basetime = coordnames['validtime'], coordnames['basetime']
+    if n_workers is not None and n_workers > 1:
+        kwargs['n_workers'] = n_workers
+    else:
+        kwargs['lazy_load'] = True
+    ds = FAEngine().open_dataset(filename, **kwargs)
+
+    if basetime in ds.dims:
+        ds = ds.isel({basetime: 0})
+    if validtime not in ds.dims:
+        ds = ds.expand_dims(validtime)
+    if basetime in ds.coords:
+        ds = ds.assign_coords({basetime: (validtime,
+                                          ds[basetime].values.reshape(1),
+                                          ds[basetime].attrs)})
+    #these differ per timestep, the times are stored as coordinates
+    for attr in ['validtime', 'basedate', 'cumuldelta']:
+        ds.attrs.pop(attr, None)
+    return ds
+
+
+def count_fields(ds: xr.Dataset, coordnames: dict) -> int:
+    """
+    Count the number of FA fields (2D fields and levels of 3D fields) in a dataset.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        The dataset.
+    coordnames : dict
+        The coordinate names (see settings).
+
+    Returns
+    -------
+    int
+        The number of FA fields.
+    """
+    horizontal = [coordnames['xdim'], coordnames['ydim'], coordnames['spectraldim']]
+    return int(sum(np.prod([ds.sizes[dim] for dim in ds[name].dims if dim not in horizontal])
+                   for name in ds.data_vars))
+
+
+def _chunk_encoding(ds: xr.Dataset, chunks: dict | None, key: str) -> dict:
+    # chunk encoding of all variables with chunked dimensions. Zarr chunks may
+    # be larger than the (appended) dimension, NetCDF chunks may not.
+    if not bool(chunks):
+        return {}
+    encoding = {}
+    for name, var in ds.variables.items():
+        if any(dim in chunks for dim in var.dims):
+            encoding[name] = {key: tuple(min(chunks.get(dim, size), size) if key == 'chunksizes'
+                                         else chunks.get(dim, size)
+                                         for dim, size in zip(var.dims, var.shape))}
+    return encoding
+
+
+def _zarr_validtimes(store, coordnames: dict) -> dict | None:
+    # valid times of the Zarr store: 'completed' (completely written) and
+    # 'written' (along the valid time dimension), None if there is no store
+    if not Path(store).exists():
+        return None
+    import zarr
+    completed = list(zarr.open_group(str(store), mode='r').attrs.get(COMPLETED_ATTR, []))
+    written = [pd.Timestamp(t).isoformat()
+               for t in xr.open_zarr(str(store))[coordnames['validtime']].values]
+    return {'completed': completed, 'written': written}
+
+
+def _write_zarr_timestep(ds: xr.Dataset, store, chunks, coordnames: dict,
+                         zarrtimes: dict | None) -> dict:
+    import zarr
+    validtime = coordnames['validtime']
+    timestamp = pd.Timestamp(ds[validtime].values[0]).isoformat()
+    if zarrtimes is None:
+        #new store
+        ds.to_zarr(str(store), mode='w', encoding=_chunk_encoding(ds, chunks, 'chunks'))
+        zarrtimes = {'completed': [], 'written': [timestamp]}
+    elif timestamp in zarrtimes['written']:
+        #interrupted while this timestep was written, overwrite it
+        index = zarrtimes['written'].index(timestamp)
+        ds.drop_vars([name for name in ds.variables if validtime not in ds[name].dims]).to_zarr(
+            str(store), region={validtime: slice(index, index + 1)})
+    else:
+        ds.to_zarr(str(store), append_dim=validtime)
+        zarrtimes['written'].append(timestamp)
+
+    zarrtimes['completed'].append(timestamp)
+    zarr.open_group(str(store), mode='a').attrs[COMPLETED_ATTR] = zarrtimes['completed']
+    return zarrtimes
+
+
+def _write_netcdf(ds: xr.Dataset, target: Path, chunks):
+    # write to a temporary file first, so an interrupted write is not taken as done
+    tmpfile = target.with_name(target.name + '.tmp')
+    ds.to_netcdf(tmpfile, encoding=_chunk_encoding(ds, chunks, 'chunksizes'))
+    os.replace(tmpfile, target)
+
+
+def main(argv=None):
+    """Console entry point: faengine-convert."""
+    parser = argparse.ArgumentParser(
+        prog='faengine-convert',
+        description='Convert FA files to a Zarr store or NetCDF files.')
+    parser.add_argument('paths', nargs='+', help='FA files (or one glob expression)')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Zarr store (*.zarr) or output directory for NetCDF')
+    parser.add_argument('--format', choices=['zarr', 'netcdf'], default=None,
+                        help='output format (default: from the output path)')
+    parser.add_argument('--chunks', default=None,
+                        help='chunk sizes per dimension, e.g. t=1,z=10,y=256,x=256')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes to decode the fields of a file (writes are serial)')
+    parser.add_argument('--whitefield-glob', nargs='+', default=['*'],
+                        help='glob expression(s) of the fields to convert')
+    parser.add_argument('--blackfield-glob', nargs='+', default=[],
+                        help='glob expression(s) of the fields to skip')
+    parser.add_argument('--inventory', default=None,
+                        help='path to a field inventory index (SQLite)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='overwrite the output instead of skipping converted files')
+    args = parser.parse_args(argv)
+
+    chunks = None
+    if args.chunks is not None:
+        chunks = {dim: int(size) for dim, size in
+                  (item.split('=') for item in args.chunks.split(','))}
+    paths = args.paths[0] if len(args.paths) == 1 else args.paths
+
+    logging.basicConfig(level=logging.INFO)
+    stats = convert(paths=paths,
+                    output=args.output,
+                    fmt=args.format,
+                    chunks=chunks,
+                    n_workers=args.workers,
+                    resume=not args.no_resume,
+                    inventory=args.inventory,
+                    whitefield_glob=args.whitefield_glob,
+                    blackfield_glob=args.blackfield_glob)
+    print(f"{stats['files']} files converted, {stats['skipped']} skipped, "
+          f"{stats['fields']} fields, {stats['bytes'] / 1e6:.1f} MB in {stats['seconds']:.1f} s "
+          f"({stats['MB/s']:.1f} MB/s, {stats['fields/s']:.1f} fields/s)")
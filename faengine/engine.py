@@ -1,6 +1,8 @@
 import logging
+import os
 from pathlib import Path
 import fnmatch
+import functools
 import re
 
 import pandas as pd
@@ -8,12 +10,16 @@ import numpy as np
 import xarray as xr
 from xarray.backends import BackendEntrypoint
 
-import epygram
-epygram.init_env()
-
 import faengine.backend.readers as readers
 import faengine.backend.formatters as formatters
-from faengine.settings import defaultsettings, default_units, default_blackfields
+from faengine.backend.arrays import (lazy_field_data, lazy_latlon_data, stack_fields, load_raw_field,
+                                     unmask_data, decoding_dtype, cast_data, preferred_chunks)
+from faengine.backend.cache import geometry_cache, field_cache, field_key
+from faengine.backend.epygram_env import load_epygram
+from faengine.backend.inventory import FieldInventory
+from faengine.backend.parallel import decode_fields
+from faengine.backend.profiling import OpenProfile, profile_stage, emit_profile
+from faengine.settings import defaultsettings, default_units, default_dtypes, default_blackfields
 
 
 
@@ -28,10 +34,24 @@ class FAEngine(BackendEntrypoint):
 
     """
     
-    # open_dataset_parameters = ["filename_or_obj", "drop_variables"]
+    open_dataset_parameters = ("filename_or_obj", "drop_variables",
+                               "whitefield_glob", "blackfield_glob",
+                               "add_latlon_coords", "create_base_dimension",
+                               "lazy_load", "bbox", "index_window",
+                               "drop_extension_zone", "levels", "n_workers",
+                               "executor", "spectral_transform", "inventory",
+                               "custom_name_settings", "custom_unit_settings",
+                               "dtype", "custom_dtype_settings", "profile")
     description =  "Use FA files in Xarray."
+    url = "https://github.com/vergauwenthomas/FAengine"
     version = "0.0.1a" #or sync with package?
 
+    def guess_can_open(self, filename_or_obj):
+        #Sniff the LFI header, Epygram is not imported (used by xarray to detect the engine)
+        if not isinstance(filename_or_obj, (str, os.PathLike)):
+            return False
+        return readers.is_fa_file(filename_or_obj)
+
 
     def open_dataset(
     self,
@@ -41,35 +61,64 @@ class FAEngine(BackendEntrypoint):
     #--- custom arguments ----
     whitefield_glob=r'*', #glob of fields
     blackfield_glob='', #glob expression 
-    add_latlon_coords= True,
+    add_latlon_coords= True, #or 'lazy': only computed when the lat/lon values are used
     create_base_dimension = True,
-    # drop_extension_zone = True,
+    lazy_load = False,
+    bbox=None, #(lon_min, lat_min, lon_max, lat_max)
+    index_window=None, #{'x': (start, stop), 'y': (start, stop)}
+    drop_extension_zone = False,
+    levels=None, #list of levels, slice or 'lowest N'
+    n_workers=None, #decode the fields in parallel with this number of spawned processes (scripts need a __main__ guard)
+    executor=None, #or with this concurrent.futures.Executor (of n_workers workers)
+    spectral_transform=True, #if False, spectral fields hold the spectral coefficients
+    inventory=None, #FieldInventory (or path to its index file) to resolve the globs without listing the file
     # construct_3d_fields=True,
     custom_name_settings={},
     custom_unit_settings={},
+    dtype=None, #output dtype of the fields, e.g. 'float32' or 'int16' (CF packed)
+    custom_dtype_settings={}, #output dtype per variable
+    profile=False, #time the stages of the open, see ds.encoding['faengine_profile']
 
     ):
+        profiler = OpenProfile(filename_or_obj) if profile else None
+        with profile_stage(profiler, 'load_epygram'):
+            epygram = load_epygram()
+
         # Update defualt settings
-        namesettings = defaultsettings
-        namesettings.update(custom_name_settings)
+        namesettings = merge_name_settings(custom_name_settings)
 
         unitsettings = default_units
         unitsettings.update(custom_unit_settings)
 
+        dtypesettings = {**default_dtypes, **custom_dtype_settings}
+
         #1 ---- Read the resource
-        r = epygram.open(
-                filename=str(filename_or_obj),
-                openmode='r',
-                fmt='FA',
-                fmtdelayedopen=True)
+        with profile_stage(profiler, 'epygram_open'):
+            r = epygram.open(
+                    filename=str(filename_or_obj),
+                    openmode='r',
+                    fmt='FA',
+                    fmtdelayedopen=True)
     
         
         # 2.--- Subset to target fields ----
-        fieldnames = find_target_fields(
-            epyresource = r,
-            whitefield_glob = whitefield_glob,
-            blackfield_glob = blackfield_glob,
-            drop_variables= drop_variables)
+        with profile_stage(profiler, 'find_target_fields'):
+            if inventory is not None:
+                if not isinstance(inventory, FieldInventory):
+                    inventory = FieldInventory(inventory)
+                fieldlist = inventory.lookup(filename_or_obj, epyresource=r)['fieldnames']
+            else:
+                fieldlist = None
+            fieldnames = find_target_fields(
+                epyresource = r,
+                whitefield_glob = whitefield_glob,
+                blackfield_glob = blackfield_glob,
+                drop_variables= drop_variables,
+                fieldlist=fieldlist)
+        if not r.isopen:
+            #the fields were found in the inventory, the frame is needed from here on
+            with profile_stage(profiler, 'epygram_open'):
+                r.open()
       
 
         # ---  Create dims ----- 
@@ -84,84 +133,262 @@ class FAEngine(BackendEntrypoint):
             dim_order.insert(0, namesettings['coordnames']['basetime'])
         
 
+        # --- Subdomain ---
+        #Note: x/y/lat/lon and the CRS are shared by all files on the same grid
+        with profile_stage(profiler, 'read_lat_lons'):
+            geometry_coords = geometry_cache.get_coordinates(
+                epyfield=r,
+                with_latlon=(add_latlon_coords is True or bbox is not None))
+        window = readers.read_subdomain_window(
+            epyfield=r,
+            bbox=bbox,
+            index_window=index_window,
+            drop_extension_zone=drop_extension_zone,
+            lons=geometry_coords.get('lon', None),
+            lats=geometry_coords.get('lat', None))
+        geometry_coords = _window_coords(geometry_coords, window)
+
         # --- Create (data) variables --- 
         H2D_fieldnameset, ATM3D_fieldnameset = triage_2d_and_3d_fields(fieldnames=fieldnames) 
-        
-        dummy_field = None
+
+        # --- Vertical levels ---
+        selected_levels = resolve_levels(levels=levels,
+                                         available_levels=readers.read_z_dim(r))
+        if selected_levels is not None:
+            #Only the crossections of the selected levels are read
+            ATM3D_fieldnameset = select_3d_levels(d3_fields=ATM3D_fieldnameset,
+                                                  levels=selected_levels)
+
+        #The time dimensions of static (PGD) files are dropped (reduce_artificial_dimensions),
+        # so they are not created for the variables.
+        time_dims = not is_static_validity(validtime=readers.read_validdate(epyfield=r),
+                                           basedate=readers.read_basedate(epyfield=r))
+
         dataset_variables = {}
+        parallel = (not lazy_load) and ((executor is not None) or
+                                        (n_workers is not None and n_workers > 1))
+        #decoded fields are reused from the field cache (if enabled)
+        cache_fields = (not lazy_load) and field_cache.enabled
+        decode = parallel or cache_fields
+        use_headers = lazy_load or decode
+        if use_headers:
+            #Only the FA headers are read, the data is read when indexed (lazy)
+            # or decoded by the workers (parallel) or taken from the field cache
+            with profile_stage(profiler, 'read_field_headers'):
+                fieldheaders = readers.read_field_headers(
+                    epyresource=r,
+                    fieldnames=fieldnames)
+
+        if decode:
+            tasks = {fieldname: [fieldname] for fieldname in H2D_fieldnameset.keys()
+                     if fieldheaders[fieldname]['structure'] == 'H2D'}
+            tasks.update(ATM3D_fieldnameset)
+            dtypes = {name: decoding_dtype(dtypesettings.get(name, dtype)) for name in tasks}
+
+            decoded_data = {}
+            if cache_fields:
+                with profile_stage(profiler, 'field_cache'):
+                    cachekeys = {name: field_key(filename=filename_or_obj,
+                                                 fieldnames=crossections,
+                                                 window=window,
+                                                 spectral_transform=spectral_transform,
+                                                 dtype=dtypes[name])
+                                 for name, crossections in tasks.items()}
+                    for name, key in cachekeys.items():
+                        cached = field_cache.get(key)
+                        if cached is not None:
+                            decoded_data[name] = cached
+            tasks = {name: crossections for name, crossections in tasks.items()
+                     if name not in decoded_data}
+
+            if parallel:
+                with profile_stage(profiler, 'decode'):
+                    decoded = decode_fields(
+                        filename=filename_or_obj,
+                        tasks=tasks,
+                        window=window,
+                        n_workers=n_workers,
+                        executor=executor,
+                        spectral_transform=spectral_transform,
+                        dtypes={name: dtypes[name] for name in tasks})
+            else:
+                decoded = {}
+                for name, crossections in tasks.items():
+                    try:
+                        with profile_stage(profiler, 'readfield', field=name):
+                            decoded[name] = stack_fields(epyresource=r,
+                                                         fieldnames=crossections,
+                                                         window=window,
+                                                         spectral_transform=spectral_transform,
+                                                         dtype=dtypes[name])
+                    except Exception as e:
+                        decoded[name] = e
+
+            if cache_fields:
+                for name, data in decoded.items():
+                    if not isinstance(data, Exception):
+                        decoded[name] = field_cache.put(cachekeys[name], data)
+            decoded_data.update(decoded)
+
         # ---- 2D Fields ----
 
         for fieldname, _ in H2D_fieldnameset.items():
-            
+            fmt_fieldname = formatters.fmt_variablename(fieldname)
+            if use_headers:
+                header = fieldheaders[fieldname]
+                if header['structure'] != 'H2D':
+                    logging.warning(f"Field '{fieldname}' is not a H2D field and will be skipped.")
+                    continue
+                fieldata = decoded_data[fieldname] if decode else None
+                if isinstance(fieldata, Exception):
+                    logging.warning(f"An error occurred reading {fieldname}: {fieldata}")
+                    continue
+                dataset_variables[fmt_fieldname] = H2D_header_to_variable(
+                    header=header,
+                    fieldata=fieldata,
+                    filename=filename_or_obj,
+                    window=window,
+                    spectral_transform=spectral_transform,
+                    create_base_dim=create_base_dimension and time_dims,
+                    create_validtime_dim=time_dims,
+                    dtype=dtypesettings.get(fieldname, dtype),
+                    namesettings=namesettings,
+                    unitsettings=unitsettings)
+                continue
+
             #Read the field
             try: 
-                field = r.readfield(fieldname)
+                with profile_stage(profiler, 'readfield', field=fieldname):
+                    #uncompressed fields are read from the file, Epygram reads the metadata
+                    rawdata = readers.read_raw_field(filename_or_obj, fieldname, window=window)
+                    if rawdata is not None:
+                        #in memory, the dataset does not depend on the file (lazy_load maps it)
+                        rawdata = load_raw_field(rawdata,
+                                                 decoding_dtype(dtypesettings.get(fieldname, dtype)))
+                    field = r.readfield(fieldname, getdata=rawdata is None)
             except Exception as e:
                 print(f"An error occurred reading {fieldname}: {e}")
             
             else:
                 if isinstance(field, epygram.fields.H2DField):
-                    fmt_fieldname = formatters.fmt_variablename(field.fid['FA'])
-                    dataset_variables[fmt_fieldname] = epy_H2D_to_variable(
-                        field=field,
-                        create_base_dim=create_base_dimension,
-                        namesettings=namesettings,
-                        unitsettings=unitsettings)
-                    if dummy_field is None:
-                        dummy_field = field
+                    if field.spectral and spectral_transform:
+                        #the field is transformed in place, by Epygram
+                        with profile_stage(profiler, 'sp2gp', field=fieldname):
+                            field.sp2gp()
+                    with profile_stage(profiler, 'to_variable', field=fieldname):
+                        dataset_variables[fmt_fieldname] = epy_H2D_to_variable(
+                            field=field,
+                            fieldata=rawdata,
+                            window=window,
+                            spectral_transform=spectral_transform,
+                            create_base_dim=create_base_dimension and time_dims,
+                            create_validtime_dim=time_dims,
+                            dtype=dtypesettings.get(fieldname, dtype),
+                            namesettings=namesettings,
+                            unitsettings=unitsettings)
                 else:
                     logging.warning(f"Field '{fieldname}' is not a H2D field and will be skipped.")
                     continue
         
         # --- 3D Fields ---- 
-        for basename in ATM3D_fieldnameset.keys():
-            fmt_fieldname = formatters.fmt_variablename(basename)
-            target_H2D_colletion = ATM3D_fieldnameset[basename]
-
-            rcl = epygram.resources.meta_resource(
-                filenames_or_resources=r,
-                openmode='r',
-                rtype= 'CL')
-            
-            #create 3d variable
-            epy_3d = construct_epy_3D(targetfieldnames=target_H2D_colletion,
-                                      epyresource=r,
-                                      epyCLresource=rcl)
-            if dummy_field is None:
-                    dummy_field = epy_3d
-            #to xarray variable
-            dataset_variables[fmt_fieldname] = epy_3D_to_vriable(field=epy_3d,
-                                                                 fieldname=basename,
-                                                                 create_base_dim=create_base_dimension,
-                                                                 namesettings=namesettings,
-                                                                 unitsettings=unitsettings)
-            #close CL resource
-            rcl.close()
+        rcl = None
+        if bool(ATM3D_fieldnameset) and not use_headers:
+            #One CombineLevels index is shared by all 3D variables of the file
+            rcl = CombineLevelsIndex(epyresource=r)
+
+        try:
+            for basename in ATM3D_fieldnameset.keys():
+                fmt_fieldname = formatters.fmt_variablename(basename)
+                target_H2D_colletion = ATM3D_fieldnameset[basename]
+
+                if use_headers:
+                    fieldata = decoded_data[basename] if decode else None
+                    if isinstance(fieldata, Exception):
+                        logging.warning(f"An error occurred reading {basename}: {fieldata}")
+                        continue
+                    dataset_variables[fmt_fieldname] = d3_headers_to_variable(
+                        headers=[fieldheaders[name] for name in target_H2D_colletion],
+                        fieldata=fieldata,
+                        fieldname=basename,
+                        filename=filename_or_obj,
+                        window=window,
+                        spectral_transform=spectral_transform,
+                        create_base_dim=create_base_dimension and time_dims,
+                        create_validtime_dim=time_dims,
+                        dtype=dtypesettings.get(basename, dtype),
+                        namesettings=namesettings,
+                        unitsettings=unitsettings)
+                    continue
+
+                #create 3d variable (when levels are selected, only the metadata
+                # is read and the data is read from the selected crossections)
+                with profile_stage(profiler, 'construct_epy_3D', field=basename):
+                    epy_3d = construct_epy_3D(targetfieldnames=target_H2D_colletion,
+                                              epyresource=r,
+                                              epyCLresource=rcl,
+                                              getdata=selected_levels is None)
+                if selected_levels is None:
+                    fieldata = None
+                else:
+                    #stack the selected levels, cast to the output dtype per level
+                    with profile_stage(profiler, 'readfield', field=basename):
+                        fieldata = stack_fields(epyresource=r,
+                                                fieldnames=target_H2D_colletion,
+                                                window=window,
+                                                spectral_transform=spectral_transform,
+                                                dtype=decoding_dtype(dtypesettings.get(basename, dtype)))
+                    if len(target_H2D_colletion) == 1:
+                        #a single level is not stacked, add its z axis
+                        fieldata = fieldata[None]
+                #to xarray variable
+                with profile_stage(profiler, 'to_variable', field=basename):
+                    dataset_variables[fmt_fieldname] = epy_3D_to_vriable(field=epy_3d,
+                                                                         fieldname=basename,
+                                                                         window=window,
+                                                                         fieldata=fieldata,
+                                                                         spectral_transform=spectral_transform,
+                                                                         create_base_dim=create_base_dimension and time_dims,
+                                                                         create_validtime_dim=time_dims,
+                                                                         dtype=dtypesettings.get(basename, dtype),
+                                                                         namesettings=namesettings,
+                                                                         unitsettings=unitsettings)
+        finally:
+            if rcl is not None:
+                #also closes the FA resource, it is reopened when it is read again
+                rcl.close()
 
 
 
 
 
         # --- Create coordinates --- 
-    
-        validtime =readers.read_validdate(epyfield=dummy_field)
+        #Note: geometry and validity are read from the FA frame (header), which
+        # is shared by all fields in the file.
+        validtime =readers.read_validdate(epyfield=r)
         dataset_coords = {
             #Dims-coords
-            namesettings['coordnames']['zdim']: readers.read_z_dim(r),
-            namesettings['coordnames']['xdim']: readers.read_x_dim(dummy_field),
-            namesettings['coordnames']['ydim']: readers.read_y_dim(dummy_field),
+            namesettings['coordnames']['zdim']: readers.read_z_dim(r, levels=selected_levels),
+            namesettings['coordnames']['xdim']: geometry_coords['x'],
+            namesettings['coordnames']['ydim']: geometry_coords['y'],
             namesettings['coordnames']['validtime']: formatters.fmt_validtime_variable(
                 validtime=validtime,
                 dimname=namesettings['coordnames']['validtime']),
         }
         if create_base_dimension:
-            referencetime = readers.read_basedate(epyfield=dummy_field)
+            referencetime = readers.read_basedate(epyfield=r)
             dataset_coords[namesettings['coordnames']['basetime']] = formatters.fmt_basedate_variable(
                 basedate=referencetime,
                 dimname=namesettings['coordnames']['basetime'])
 
         if add_latlon_coords:
-            lons, lats = readers.read_lat_lons(epyfield=dummy_field)
+            lons, lats = latlon_arrays(geometry_coords=geometry_coords,
+                                       filename=filename_or_obj,
+                                       epyresource=r,
+                                       window=window)
+            if dtype is not None and np.dtype(dtype).kind == 'f' and 'lat' in geometry_coords:
+                #the coordinates follow a (reduced) floating point output dtype,
+                # they are not packed in an integer output dtype
+                lons, lats = lons.astype(dtype, copy=False), lats.astype(dtype, copy=False)
             #Dependent coords
             dataset_coords[namesettings['coordnames']['latcoord']]= formatters.fmt_lat_variable(lats)
             dataset_coords[namesettings['coordnames']['loncoord']]= formatters.fmt_lon_variable(lons)
@@ -171,21 +398,20 @@ class FAEngine(BackendEntrypoint):
 
         #1. Read the CRS whitefield_glob: str | list,
         
-        crs = readers.read_proj(epyfield=dummy_field) #read
-        dataset_attrs['proj_crs'] = formatters.fmt_proj(crs) # format
+        dataset_attrs['proj_crs'] = geometry_coords['proj_crs'] # read and formatted
 
         #2. Time details
-        validtime = readers.read_validdate(epyfield=dummy_field)
+        validtime = readers.read_validdate(epyfield=r)
         dataset_attrs['validtime'] = formatters.fmt_timestamp_to_str(validtime)
 
-        basedate = readers.read_basedate(epyfield=dummy_field)
+        basedate = readers.read_basedate(epyfield=r)
         dataset_attrs['basedate'] = formatters.fmt_timestamp_to_str(basedate)
 
-        cumul_delta = readers.read_cumulativeduration(epyfield=dummy_field)
+        cumul_delta = readers.read_cumulativeduration(epyfield=r)
         dataset_attrs['cumuldelta'] = formatters.fmt_timedelta_to_str(cumul_delta)
 
         #3. Vertical details
-        vertical_details = readers.read_vertical_attrs(r)
+        vertical_details = readers.read_vertical_attrs(r, levels=selected_levels)
         dataset_attrs.update(formatters.fmt_dict_for_attrs(vertical_details))
     
         #Construct the dataset
@@ -193,85 +419,166 @@ class FAEngine(BackendEntrypoint):
                         coords={**dataset_coords},
                         attrs=dataset_attrs)
         
-        #Close the readers
-        r.close() #this becomes problematic when lazy-loading i think.
-
-        ds = reduce_artificial_dimensions(ds=ds, namesettings=namesettings)
+        #Close the readers (lazy variables reopen the file when they are indexed)
+        r.close()
+
+        with profile_stage(profiler, 'reduce_artificial_dimensions'):
+            ds = reduce_artificial_dimensions(ds=ds, namesettings=namesettings)
+        ds = unpack_variables(ds)
+
+        if profiler is not None:
+            if not lazy_load:
+                #bytes of the decoded data
+                for name in [*H2D_fieldnameset, *ATM3D_fieldnameset]:
+                    fmt_name = formatters.fmt_variablename(name)
+                    if fmt_name in dataset_variables:
+                        profiler.add_bytes(name, dataset_variables[fmt_name].nbytes)
+            ds.encoding['faengine_profile'] = emit_profile(profiler)
         
         return ds
 
 
 
+def merge_name_settings(custom_name_settings: dict) -> dict:
+    """
+    Merge custom name settings over the default name settings.
+
+    The coordinate names are merged per name, so custom settings only need
+    the names that differ from the defaults. The defaults are not modified.
+
+    Args:
+        custom_name_settings (dict): The custom name settings.
+
+    Returns:
+        dict: The name settings.
+    """
+    return {**defaultsettings,
+            **custom_name_settings,
+            'coordnames': {**defaultsettings['coordnames'],
+                           **custom_name_settings.get('coordnames', {})}}
+
+
+def latlon_arrays(geometry_coords: dict, filename, epyresource, window=None) -> tuple:
+    #The (cached) lat/lon grids, or lazy grids that are projected when used
+    if 'lat' in geometry_coords:
+        return geometry_coords['lon'], geometry_coords['lat']
+    return lazy_latlon_data(filename=filename,
+                            fingerprint=readers.read_geometry_fingerprint(epyresource),
+                            shape=(len(geometry_coords['y']), len(geometry_coords['x'])),
+                            window=window)
+
+
+def unpack_variables(ds: xr.Dataset) -> xr.Dataset:
+    #The packed (integer) variables are unpacked when their values are used, 
+    # the packing is kept in the encoding (and reused when writing)
+    for name, var in ds.data_vars.items():
+        if 'scale_factor' in var.attrs:
+            ds[name] = xr.conventions.decode_cf_variable(name, var.variable,
+                                                         decode_times=False,
+                                                         decode_timedelta=False)
+    return ds
+
+
 def find_target_fields(
         epyresource,
         whitefield_glob: str | list,
         blackfield_glob: str | list | None,
-        drop_variables: list | None) -> list:
-    
-    #1.--- White fields --------
+        drop_variables: list | None,
+        fieldlist: list | None = None) -> list:
 
+    #The globs are resolved on a field list (from an inventory) or on the resource
+    if fieldlist is None:
+        fieldlist = epyresource.listfields()
+
+    #1.--- White fields --------
     if isinstance(whitefield_glob, str):
-        fieldnames = epyresource.find_fields_in_resource(whitefield_glob)
-    elif isinstance(whitefield_glob, list):
-        fieldnames = []
-        for whiteglob in whitefield_glob:
-            try:
-                fieldnames.extend(epyresource.find_fields_in_resource(whiteglob))
-            except epygram.epygramError:
-                pass
-    else:
+        whitefield_glob = [whitefield_glob]
+    elif not isinstance(whitefield_glob, list):
         raise TypeError(f'whitelist_glob is not of type str or list but {type(whitefield_glob)}')
 
-    
-    if not bool(fieldnames):
-        raise ValueError(f'No fields found for {whitefield_glob}! Here are all the fields: {epyresource.listfields()}.')
-
     #2. ---- Blackfields -----
-    if isinstance(blackfield_glob, str):
-        try:
-            blackfields = epyresource.find_fields_in_resource(blackfield_glob)
-        except epygram.epygramError:
-            blackfields = []
-    elif isinstance(blackfield_glob, list):
-        blackfields = []
-        for blackglob in blackfield_glob:
-            blackfields.extend(epyresource.find_fields_in_resource(blackglob))
-    elif blackfield_glob is None:
-        blackfields = []
-    else:
+    if blackfield_glob is None:
+        blackfield_glob = []
+    elif isinstance(blackfield_glob, str):
+        blackfield_glob = [blackfield_glob]
+    elif not isinstance(blackfield_glob, list):
         raise TypeError(f'blackfield_glob is not in a supported type.')
-    
-    #remove blackfields from targets
-    fieldnames = list(set(fieldnames) - set(blackfields))
-
-    #apply default blacklist
-    fieldnames = list(set(fieldnames)- set(default_blackfields))
-
 
     #3. ----- Dropfields ----- 
-    # --- Apply drop_variables functionality ---
+    #default blacklist and drop_variables functionality
+    excluded = set(default_blackfields)
     if drop_variables is not None:
         if isinstance(drop_variables, str):
             drop_variables = [drop_variables]
-        fieldnames = list(set(fieldnames)- set(drop_variables))
-    
-    return fieldnames
+        excluded.update(drop_variables)
+
+    fieldnames, found = _select_fields(fieldlist=tuple(fieldlist),
+                                       whiteglobs=tuple(whitefield_glob),
+                                       blackglobs=tuple(blackfield_glob),
+                                       excluded=frozenset(excluded))
+    if not found:
+        raise ValueError(f'No fields found for {whitefield_glob}! Here are all the fields: {list(fieldlist)}.')
+    return list(fieldnames)
+
+
+@functools.lru_cache(maxsize=256)
+def _select_fields(fieldlist: tuple, whiteglobs: tuple, blackglobs: tuple,
+                   excluded: frozenset) -> tuple:
+    # One pass over the fields of a file, the selection is cached per field list
+    # (so per file) and set of globs. Returns the selection and whether any
+    # field matched the white globs.
+    white = _compile_globs(whiteglobs)
+    black = _compile_globs(blackglobs)
+    found = False
+    fieldnames = []
+    for fieldname in fieldlist:
+        if white is None or white.match(fieldname) is None:
+            continue
+        found = True
+        if fieldname in excluded or (black is not None and black.match(fieldname)):
+            continue
+        fieldnames.append(fieldname)
+    return tuple(fieldnames), found
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_globs(globs: tuple) -> re.Pattern | None:
+    # All (unix shell style) globs as one regular expression, None if no globs
+    globs = [glob for glob in globs if bool(glob)]
+    if not bool(globs):
+        return None
+    return re.compile('|'.join(fnmatch.translate(glob) for glob in globs))
+
+
+
+def is_static_validity(validtime, basedate) -> bool:
+    """
+    Test if the validity of an FA file is the one of a static (PGD) file.
 
+    Args:
+        validtime (str or pd.Timestamp): The valid time of the file.
+        basedate (str or pd.Timestamp): The base date of the file.
+    Returns:
+        bool: True if the file is static (valid time is the unix epoch and equal
+            to the base date).
+    """
+    unix_epoch = pd.Timestamp(0)
+    return bool(((pd.Timestamp(validtime) - unix_epoch) < pd.Timedelta('1s')) &
+                (pd.Timestamp(basedate) == pd.Timestamp(validtime)))
 
 
 def reduce_artificial_dimensions(ds, namesettings):
     #test if the FA file is static --> PGD file
-    unix_epoch = pd.Timestamp(0)
-    is_pgd = (((pd.Timestamp(ds.attrs['validtime']) - unix_epoch) < pd.Timedelta('1s')) &
-        ((ds.attrs['basedate'] == ds.attrs['validtime'])))
+    is_pgd = is_static_validity(validtime=ds.attrs['validtime'],
+                                basedate=ds.attrs['basedate'])
     
     if is_pgd:
         ds.attrs['PGD_detected'] = 'True'
-        #Drop all the time dimensions 
-        ds = (ds
-              .isel({namesettings['coordnames']['validtime']:0,
-                     namesettings['coordnames']['basetime']: 0})
-            )
+        #Drop all the time dimensions (only the coordinates have them, the
+        # variables of static files are created without)
+        timedims = [namesettings['coordnames']['validtime'],
+                    namesettings['coordnames']['basetime']]
+        ds = ds.isel({dim: 0 for dim in timedims if dim in ds.dims})
     else: 
         ds.attrs['PGD_detected'] = 'False'
 
@@ -306,14 +613,11 @@ def triage_2d_and_3d_fields(fieldnames, d3rex="^S[0-9][0-9][0-9].*"):
     d3_fields = {} 
     d3regex = re.compile(d3rex)
 
-    unassigned_fields = fieldnames.copy()
-    for field in unassigned_fields: 
+    #Single pass: the S### prefix is parsed once and the field is bucketed by its base name
+    for field in fieldnames: 
         if bool(d3regex.match(field)):
-            basefieldname=field[4:]
-            specific_rex = re.compile(f'{d3rex}{basefieldname}') #regex to match all fields with the same base name end
             #field is member of 3d fields
-            newlist = list(filter(specific_rex.match, unassigned_fields)) # Read Note below
-            d3_fields[basefieldname] = newlist 
+            d3_fields.setdefault(field[4:], []).append(field)
         else:
             d2_fields[field] = field
 
@@ -325,9 +629,129 @@ def triage_2d_and_3d_fields(fieldnames, d3rex="^S[0-9][0-9][0-9].*"):
     return d2_fields, d3_fields
 
 
+def resolve_levels(levels, available_levels) -> list | None:
+    """
+    Resolve a level selection to a list of level numbers.
+
+    Args:
+        levels (list, int, slice, str or None): The level selection:
+            - None: all levels (no selection).
+            - int or list of int: the level numbers.
+            - slice: applied on the available levels (positional, like isel).
+            - 'lowest N': the N levels nearest to the surface, these are the
+              levels with the highest level numbers (hybrid levels are
+              numbered from the top down).
+        available_levels (array-like): The level numbers present in the file.
+    Returns:
+        list or None: The selected level numbers (in the order of the available
+            levels), or None if no selection is made.
+    """
+    if levels is None:
+        return None
+
+    available_levels = list(available_levels)
+    if isinstance(levels, str):
+        match = re.match(r'^lowest\s*(\d+)$', levels.strip())
+        if match is None:
+            raise ValueError(f"levels as str must be of the form 'lowest N', not {levels}")
+        nlowest = int(match.group(1))
+        selected = available_levels[-nlowest:] if nlowest > 0 else []
+    elif isinstance(levels, slice):
+        selected = available_levels[levels]
+    elif isinstance(levels, (int, np.integer)):
+        selected = [level for level in available_levels if level == levels]
+    elif isinstance(levels, (list, tuple, np.ndarray)):
+        selected = [level for level in available_levels if level in set(levels)]
+    else:
+        raise TypeError(f'levels is not of type list, int, slice or str but {type(levels)}')
+
+    if not bool(selected):
+        raise ValueError(f'No levels found for {levels}! Available levels: {available_levels}.')
+    return selected
+
+
+def select_3d_levels(d3_fields:dict, levels:list) -> dict:
+    """
+    Subset the crossections of the 3D fields to the given levels.
+
+    Args:
+        d3_fields (dict): 3D fields, as returned by triage_2d_and_3d_fields.
+        levels (list): The level numbers to keep.
+    Returns:
+        dict: The 3D fields with only the crossections on the given levels. 3D
+            fields without any crossection on these levels are dropped.
+    """
+    levels = set(int(level) for level in levels)
+    selected_fields = {}
+    for basename, fields in d3_fields.items():
+        selected = [field for field in fields if int(field[1:4]) in levels]
+        if bool(selected):
+            selected_fields[basename] = selected
+        else:
+            logging.warning(f"3D field '{basename}' has no crossections on the selected levels and will be skipped.")
+    return selected_fields
+
+
+class CombineLevelsIndex:
+    """
+    CombineLevels (CL) resource with a precomputed index of its 3D fields.
+
+    One CL resource is created per file and shared by all the 3D variables.
+    Its field list (listfields) is read once, and the lookups on the generic
+    fid are answered from a dict. Only the public Epygram API is used: the
+    fields are read with the readfield method of the CL resource.
+
+    Parameters
+    ----------
+    epyresource : Epygram resource
+        The (FA) Epygram resource object, opened in 'r' mode.
+    """
+
+    # keys of the generic fid used to index the 3D fields
+    index_keys = ('discipline',
+                  'parameterCategory',
+                  'parameterNumber')
+
+    def __init__(self, epyresource):
+        epygram = load_epygram()
+        self.epyCLresource = epygram.resources.meta_resource(
+            filenames_or_resources=epyresource,
+            openmode='r',
+            rtype='CL')
+
+        #the field list of a resource opened in 'r' mode does not change
+        self._fids = self.epyCLresource.listfields(complete=True)
+        self._fid_index = {}
+        for fid in self._fids:
+            self._fid_index.setdefault(self._index_key(fid['generic']), []).append(fid)
+
+    @classmethod
+    def _index_key(cls, generic_fid: dict) -> tuple:
+        return tuple(generic_fid.get(key, None) for key in cls.index_keys)
+
+    def find_fields_in_resource_by_generic_fid(self, handgrip: dict) -> list:
+        """Find the CL fields whose generic fid matches the handgrip."""
+        if all(key in handgrip for key in self.index_keys):
+            candidates = self._fid_index.get(self._index_key(handgrip), [])
+        else:
+            candidates = self._fids
+        return [fid for fid in candidates
+                if all(key in fid['generic'] and fid['generic'][key] == val
+                       for key, val in handgrip.items())]
+
+    def readfield(self, handgrip, getdata=True):
+        """Read a 3D field from the CL resource."""
+        return self.epyCLresource.readfield(handgrip, getdata=getdata)
+
+    def close(self):
+        """Close the CL resource (and the FA resource it is built on)."""
+        self.epyCLresource.close()
+
+
 def construct_epy_3D(targetfieldnames:list,
                        epyresource,
                        epyCLresource,
+                       getdata:bool=True,
                        ):
     
 
@@ -339,8 +763,8 @@ def construct_epy_3D(targetfieldnames:list,
     #Get a dummy H2D field that is a crossection of the 3D field:
     dummy_crossec_fieldname = targetfieldnames[0]
 
-    #get the fid of that variable
-    target_fid_dict = epyresource.readfield(dummy_crossec_fieldname).fid['generic']
+    #get the fid of that variable (metadata only, the data is not needed)
+    target_fid_dict = epyresource.readfield(dummy_crossec_fieldname, getdata=False).fid['generic']
 
     #Construct a FID for selecing the 3D field
 
@@ -379,33 +803,38 @@ def construct_epy_3D(targetfieldnames:list,
 
     #read the field
     d3target_fid_dict = candidates[0]['CombineLevels']
-    d3field = epyCLresource.readfield(d3target_fid_dict)
+    d3field = epyCLresource.readfield(d3target_fid_dict, getdata=getdata)
 
     return d3field
 
 
 def epy_3D_to_vriable(field, fieldname, create_base_dim:bool, namesettings:dict,
-                         unitsettings:dict):
-    if field.spectral:
-            field.sp2gp()
-
-
-    #TODO extract subdomain
-
-    #Add trivial time dimension
-    fieldata = np.array([field.data]) #add trivial time dimension
+                         unitsettings:dict, window=None, fieldata=None,
+                         spectral_transform=True, create_validtime_dim=True,
+                         dtype=None):
+    raw_spectral = field.spectral and not spectral_transform
+    if fieldata is None:
+        if field.spectral and spectral_transform:
+                field.sp2gp()
+
+        fieldata = field.data
+        #extract subdomain
+        if window is not None and not raw_spectral:
+            fieldata = fieldata[(slice(None), *window)]
+    #else: the decoded (selected) levels, the 3D field only holds the metadata
+
+    #cast to the output dtype (and pack)
+    fieldata, packing_attrs = cast_data(unmask_data(fieldata), dtype)
 
     # Name the dimensions of the field (ORDER IS IMPORTANT)
     fielddim_order = [
-        namesettings['coordnames']['validtime'],
         namesettings['coordnames']['zdim'],
-        namesettings['coordnames']['ydim'],
-        namesettings['coordnames']['xdim']]
-    
-    # Add extra reference time dimension (Cycling experiments)
-    if create_base_dim:
-        fieldata =  np.array([fieldata])
-        fielddim_order.insert(0, namesettings['coordnames']['basetime'])
+        *_horizontal_dims(namesettings, raw_spectral)]
+
+    #Add the trivial time dimensions (as a view, the field is not copied)
+    timedims = _time_dims(namesettings, create_validtime_dim, create_base_dim)
+    fielddim_order = [*timedims, *fielddim_order]
+    fieldata = fieldata[(None,) * len(timedims)]
 
 
     # --- Create attributes ---
@@ -414,6 +843,7 @@ def epy_3D_to_vriable(field, fieldname, create_base_dim:bool, namesettings:dict,
     field_attrs.update(
         {'short_name': fieldname}
     )
+    field_attrs.update(packing_attrs)
     
     #unit attributes
     if fieldname in unitsettings.keys():
@@ -433,27 +863,32 @@ def epy_3D_to_vriable(field, fieldname, create_base_dim:bool, namesettings:dict,
 
 
 def epy_H2D_to_variable(field, create_base_dim:bool, namesettings:dict,
-                         unitsettings:dict):
-    if field.spectral:
+                         unitsettings:dict, window=None,
+                         spectral_transform=True, create_validtime_dim=True,
+                         dtype=None, fieldata=None):
+    raw_spectral = field.spectral and not spectral_transform
+    if fieldata is None:
+        if field.spectral and spectral_transform:
+            #the field is transformed in place (if not done by the caller)
             field.sp2gp()
-
-    #TODO extract subdomain
+        fieldata = field.data
+        #extract subdomain
+        if window is not None and not raw_spectral:
+            fieldata = fieldata[window]
+    #else: read from the file (see readers.read_raw_field), subdomain included
+    #cast to the output dtype (and pack)
+    fieldata, packing_attrs = cast_data(unmask_data(fieldata), dtype)
 
     #get fieldname
     fieldname = field.fid['FA']
 
-    #Add trivial time dimension
-    fieldata = np.array([field.data]) #add trivial time dimension
-
     # Name the dimensions of the field (ORDER IS IMPORTANT)
-    fielddim_order = [
-        namesettings['coordnames']['validtime'],
-        namesettings['coordnames']['ydim'],
-        namesettings['coordnames']['xdim']] 
-    # Add extra reference time dimension (Cycling experiments)
-    if create_base_dim:
-        fieldata =  np.array([fieldata])
-        fielddim_order.insert(0, namesettings['coordnames']['basetime'])
+    fielddim_order = _horizontal_dims(namesettings, raw_spectral)
+
+    #Add the trivial time dimensions (as a view, the field is not copied)
+    timedims = _time_dims(namesettings, create_validtime_dim, create_base_dim)
+    fielddim_order = [*timedims, *fielddim_order]
+    fieldata = fieldata[(None,) * len(timedims)]
 
 
     # --- Create attributes ---
@@ -462,6 +897,7 @@ def epy_H2D_to_variable(field, create_base_dim:bool, namesettings:dict,
     field_attrs.update(
         {'short_name': fieldname}
     )
+    field_attrs.update(packing_attrs)
     
     #unit attributes
     if fieldname in unitsettings.keys():
@@ -480,3 +916,174 @@ def epy_H2D_to_variable(field, create_base_dim:bool, namesettings:dict,
             )
     return var
 
+
+
+def H2D_header_to_variable(header:dict, filename, create_base_dim:bool,
+                           namesettings:dict, unitsettings:dict, window=None,
+                           fieldata=None, spectral_transform=True,
+                           create_validtime_dim=True, dtype=None):
+    #get fieldname
+    fieldname = header['fid']['FA']
+    raw_spectral = header['spectral'] and not spectral_transform
+
+    # Name the dimensions of the field (ORDER IS IMPORTANT)
+    fielddim_order = _horizontal_dims(namesettings, raw_spectral)
+    #add the trivial time dimensions
+    timedims = _time_dims(namesettings, create_validtime_dim, create_base_dim)
+    fielddim_order = [*timedims, *fielddim_order]
+    fieldshape = (*[1] * len(timedims), *_header_shape(header, window, raw_spectral))
+
+    packing_attrs, encoding = {}, {}
+    if fieldata is None:
+        #The field is read (and decoded) when indexed
+        fieldata = lazy_field_data(filename=filename,
+                                   fieldnames=[fieldname],
+                                   shape=fieldshape,
+                                   dtype=_lazy_dtype(header, dtype),
+                                   window=window,
+                                   spectral_transform=spectral_transform)
+        #one chunk per field (and per level), read by its own task
+        encoding['preferred_chunks'] = preferred_chunks(dims=fielddim_order,
+                                                        shape=fieldshape,
+                                                        field_dims=_horizontal_dims(namesettings, raw_spectral))
+    else:
+        #Already decoded (and subsetted) data
+        fieldata, packing_attrs = cast_data(fieldata.reshape(fieldshape), dtype)
+
+    # --- Create attributes ---
+    #FID attributes
+    field_attrs = readers.read_h2d_header_attrs(header)
+    field_attrs.update(
+        {'short_name': fieldname}
+    )
+    field_attrs.update(packing_attrs)
+
+    #unit attributes
+    if fieldname in unitsettings.keys():
+        unit = unitsettings[fieldname]
+    else:
+        unit='Unknown'
+    field_attrs['units'] = unit
+
+    #to xarray
+    var = xr.Variable(
+            dims=fielddim_order,
+            data=fieldata,
+            attrs=formatters.fmt_dict_for_attrs(field_attrs),
+            encoding=encoding,
+            )
+    return var
+
+
+def d3_headers_to_variable(headers:list, fieldname, filename, create_base_dim:bool,
+                           namesettings:dict, unitsettings:dict, window=None,
+                           fieldata=None, spectral_transform=True,
+                           create_validtime_dim=True, dtype=None):
+    raw_spectral = headers[0]['spectral'] and not spectral_transform
+
+    # Name the dimensions of the field (ORDER IS IMPORTANT)
+    fielddim_order = [
+        namesettings['coordnames']['zdim'],
+        *_horizontal_dims(namesettings, raw_spectral)]
+    #add the trivial time dimensions
+    timedims = _time_dims(namesettings, create_validtime_dim, create_base_dim)
+    fielddim_order = [*timedims, *fielddim_order]
+    fieldshape = (*[1] * len(timedims), len(headers),
+                  *_header_shape(headers[0], window, raw_spectral))
+
+    packing_attrs, encoding = {}, {}
+    if fieldata is None:
+        #The crossections are read (and decoded) when indexed, and stacked along z
+        fieldata = lazy_field_data(filename=filename,
+                                   fieldnames=[header['fid']['FA'] for header in headers],
+                                   shape=fieldshape,
+                                   dtype=_lazy_dtype(headers[0], dtype),
+                                   window=window,
+                                   spectral_transform=spectral_transform)
+        #one chunk per field (and per level), read by its own task
+        encoding['preferred_chunks'] = preferred_chunks(dims=fielddim_order,
+                                                        shape=fieldshape,
+                                                        field_dims=_horizontal_dims(namesettings, raw_spectral))
+    else:
+        #Already decoded (and subsetted) data
+        fieldata, packing_attrs = cast_data(fieldata.reshape(fieldshape), dtype)
+
+    # --- Create attributes ---
+    #FID attributes
+    field_attrs = readers.read_3d_header_attrs(headers)
+    field_attrs.update(
+        {'short_name': fieldname}
+    )
+    field_attrs.update(packing_attrs)
+
+    #unit attributes
+    if fieldname in unitsettings.keys():
+        unit = unitsettings[fieldname]
+    else:
+        unit='Unknown'
+    field_attrs['units'] = unit
+
+    #to xarray
+    var = xr.Variable(
+            dims=fielddim_order,
+            data=fieldata,
+            attrs=formatters.fmt_dict_for_attrs(field_attrs),
+            encoding=encoding,
+            )
+    return var
+
+
+def _window_shape(shape:tuple, window) -> tuple:
+    #shape of the (y, x) gridpoint data after extracting the subdomain window
+    if window is None:
+        return tuple(shape)
+    return tuple(len(range(*dimwindow.indices(dimsize)))
+                 for dimwindow, dimsize in zip(window, shape))
+
+
+def _window_coords(geometry_coords:dict, window) -> dict:
+    #crop the coordinates to the subdomain (views on the shared arrays)
+    if window is None:
+        return geometry_coords
+    geometry_coords['y'] = geometry_coords['y'][window[0]]
+    geometry_coords['x'] = geometry_coords['x'][window[1]]
+    if 'lat' in geometry_coords:
+        geometry_coords['lat'] = geometry_coords['lat'][window]
+        geometry_coords['lon'] = geometry_coords['lon'][window]
+    return geometry_coords
+
+
+def _header_shape(header:dict, window, raw_spectral:bool) -> tuple:
+    #shape of the field data, as read from the header
+    if raw_spectral:
+        return tuple(header['spectral_shape'])
+    return _window_shape(header['shape'], window)
+
+
+def _horizontal_dims(namesettings:dict, raw_spectral:bool) -> list:
+    #spectral coefficients are stored along one (spectral) dimension instead of y/x
+    if raw_spectral:
+        return [namesettings['coordnames']['spectraldim']]
+    return [namesettings['coordnames']['ydim'],
+            namesettings['coordnames']['xdim']]
+
+
+def _time_dims(namesettings:dict, create_validtime_dim:bool, create_base_dim:bool) -> list:
+    #the trivial time dimensions that are prepended to the field dimensions
+    timedims = []
+    if create_base_dim:
+        # extra reference time dimension (Cycling experiments)
+        timedims.append(namesettings['coordnames']['basetime'])
+    if create_validtime_dim:
+        timedims.append(namesettings['coordnames']['validtime'])
+    return timedims
+
+
+def _lazy_dtype(header:dict, dtype):
+    #the data of lazy variables is cast when read, packing needs the values up front
+    if dtype is None:
+        return header['dtype']
+    if np.dtype(dtype).kind != 'f':
+        raise ValueError(f'dtype {dtype} is not supported with lazy_load, use a floating point type.')
+    return np.dtype(dtype)
+
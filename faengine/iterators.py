@@ -0,0 +1,98 @@
+""" Generators that stream FA data one field or one timestep at a time. """
+
+from faengine.backend.inventory import FieldInventory, scan_inventory_entry
+from faengine.engine import FAEngine
+from faengine.mfdataset import expand_paths
+
+
+def iter_fields(filename, whitefield_glob=r'*', blackfield_glob='', **kwargs):
+    """
+    Iterate over the fields of an FA file, reading one field at a time.
+
+    The file is opened lazily (only the headers are read), and every field is
+    read and decoded when it is yielded. The coordinates are created once and
+    shared by all yielded fields, so the memory use stays near one field as
+    long as the caller releases the fields it is done with.
+
+    Parameters
+    ----------
+    filename : str or Path
+        Path to the FA file.
+    whitefield_glob : str or list, optional
+        Glob expression(s) of the target fields. Default is '*'.
+    blackfield_glob : str or list, optional
+        Glob expression(s) of fields to skip. Default is ''.
+    **kwargs
+        Other arguments of FAEngine.open_dataset (lazy_load is always True).
+
+    Yields
+    ------
+    xarray.DataArray
+        One (H2D or 3D) field, with its data loaded.
+    """
+    kwargs['lazy_load'] = True
+    ds = FAEngine().open_dataset(filename,
+                                 whitefield_glob=whitefield_glob,
+                                 blackfield_glob=blackfield_glob,
+                                 **kwargs)
+    for name in ds.data_vars:
+        #compute loads a (shallow) copy, the lazy dataset does not keep the data
+        yield ds[name].compute()
+
+
+def iter_timesteps(paths, inventory=None, **kwargs):
+    """
+    Iterate over FA files in the order of their validity, one dataset per file.
+
+    The files are ordered on (base time, valid time) from their headers. Each
+    yielded dataset is opened lazily: no field data is read until it is used,
+    so the caller can process (and release) one timestep at a time.
+
+    Parameters
+    ----------
+    paths : str or list
+        Glob expression of the FA files, or a list of paths.
+    inventory : FieldInventory or str, optional
+        Inventory (or path to its index file) used to get the validity of
+        indexed files without opening them. Default is None.
+    **kwargs
+        Other arguments of FAEngine.open_dataset (lazy_load is always True).
+
+    Yields
+    ------
+    xarray.Dataset
+        The lazily loaded dataset of one FA file.
+    """
+    if inventory is not None and not isinstance(inventory, FieldInventory):
+        inventory = FieldInventory(inventory)
+    kwargs['lazy_load'] = True
+    for filename, _ in sort_by_validity(paths, inventory=inventory):
+        yield FAEngine().open_dataset(filename, inventory=inventory, **kwargs)
+
+
+def sort_by_validity(paths, inventory=None) -> list:
+    """
+    Sort FA files on their (base time, valid time), read from the headers.
+
+    Parameters
+    ----------
+    paths : str or list
+        Glob expression of the FA files, or a list of paths.
+    inventory : FieldInventory, optional
+        Inventory used to get the validity of indexed files without opening
+        them. Default is None.
+
+    Returns
+    -------
+    list of tuple
+        The (path, inventory entry) of the FA files, in the order of their
+        validity.
+    """
+    filenames = expand_paths(paths)
+    if inventory is None:
+        entries = [scan_inventory_entry(filename) for filename in filenames]
+    else:
+        entries = [inventory.lookup(filename) for filename in filenames]
+    order = sorted(range(len(filenames)),
+                   key=lambda i: (entries[i]['basedate'], entries[i]['validdate']))
+    return [(filenames[i], entries[i]) for i in order]
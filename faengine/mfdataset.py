@@ -0,0 +1,293 @@
+""" Open a series of FA files as one (lazy) dataset. """
+
+import glob
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import faengine.backend.readers as readers
+import faengine.backend.formatters as formatters
+from faengine.backend.arrays import FA_LOCK, open_fa_resource, lazy_multifile_data, preferred_chunks
+from faengine.backend.cache import geometry_cache
+from faengine.backend.inventory import FieldInventory, scan_inventory_entry
+from faengine.engine import (find_target_fields, triage_2d_and_3d_fields,
+                             resolve_levels, select_3d_levels, latlon_arrays,
+                             merge_name_settings, _header_shape, _horizontal_dims,
+                             _window_coords)
+from faengine.settings import default_units
+
+
+def open_fa_mfdataset(
+        paths,
+        whitefield_glob=r'*',
+        blackfield_glob='',
+        drop_variables=None,
+        add_latlon_coords=True,
+        create_base_dimension=True,
+        bbox=None,
+        index_window=None,
+        drop_extension_zone=False,
+        levels=None,
+        spectral_transform=True,
+        inventory=None,
+        custom_name_settings={},
+        custom_unit_settings={},
+        ) -> xr.Dataset:
+    """
+    Open multiple FA files (e.g. all lead times of a run) as one dataset.
+
+    Only the headers of the files are scanned: the field inventory and the
+    validity of every file, and the field descriptors and the geometry of the
+    first file. The files must share the same geometry. The base time and
+    valid time axes are built from the validities, and every variable is
+    backed by a lazy array that reads a field from a file when that part of
+    the data is used.
+
+    Parameters
+    ----------
+    paths : str or list
+        Glob expression of the FA files, or a list of paths.
+    whitefield_glob : str or list, optional
+        Glob expression(s) of the target fields. Default is '*'.
+    blackfield_glob : str or list, optional
+        Glob expression(s) of fields to skip. Default is ''.
+    drop_variables : str or list, optional
+        Fieldnames to skip. Default is None.
+    add_latlon_coords : bool or str, optional
+        If True, 2D latitude and longitude coordinates are added. If 'lazy',
+        these are only computed when their values are used. Default is True.
+    create_base_dimension : bool, optional
+        If True, a base time dimension is created. If False, each valid time
+        must be present in only one file. Default is True.
+    bbox, index_window, drop_extension_zone, levels, spectral_transform :
+        See FAEngine.open_dataset.
+    inventory : FieldInventory or str, optional
+        Inventory (or path to its index file) used to get the field inventory
+        and validity of indexed files without opening them. Default is None.
+    custom_name_settings : dict, optional
+        Overrides of the default (coordinate) names.
+    custom_unit_settings : dict, optional
+        Overrides of the default units.
+
+    Returns
+    -------
+    xarray.Dataset
+        The lazily loaded dataset.
+    """
+    #the module defaults are not modified, custom settings do not leak into other opens
+    namesettings = merge_name_settings(custom_name_settings)
+    unitsettings = {**default_units, **custom_unit_settings}
+
+    # --- Scan the headers ---
+    filenames = expand_paths(paths)
+
+    if inventory is not None and not isinstance(inventory, FieldInventory):
+        inventory = FieldInventory(inventory)
+    if inventory is None:
+        entries = [scan_inventory_entry(filename) for filename in filenames]
+    else:
+        entries = [inventory.lookup(filename) for filename in filenames]
+
+    if len(set(entry['geometry'] for entry in entries)) > 1:
+        raise ValueError('The FA files do not share the same geometry.')
+
+    # --- Target fields (present in all files) ---
+    targets = [find_target_fields(epyresource=None,
+                                  whitefield_glob=whitefield_glob,
+                                  blackfield_glob=blackfield_glob,
+                                  drop_variables=drop_variables,
+                                  fieldlist=entry['fieldnames'])
+               for entry in entries]
+    common = set.intersection(*(set(filefields) for filefields in targets))
+    fieldnames = [field for field in targets[0] if field in common]
+    missing = set.union(*(set(filefields) for filefields in targets)) - common
+    if bool(missing):
+        logging.warning(f'Fields {sorted(missing)} are not present in all files and will be skipped.')
+
+    # --- Time axes ---
+    filegrid, basedates, validdates = _build_filegrid(filenames, entries, create_base_dimension)
+
+    # --- Frame of the first file: geometry, field descriptors and vertical details ---
+    with FA_LOCK:
+        r = open_fa_resource(filenames[0])
+        try:
+            r.open()
+            geometry_coords = geometry_cache.get_coordinates(
+                epyfield=r,
+                with_latlon=(add_latlon_coords is True or bbox is not None))
+            window = readers.read_subdomain_window(
+                epyfield=r,
+                bbox=bbox,
+                index_window=index_window,
+                drop_extension_zone=drop_extension_zone,
+                lons=geometry_coords.get('lon', None),
+                lats=geometry_coords.get('lat', None))
+            selected_levels = resolve_levels(levels=levels,
+                                             available_levels=readers.read_z_dim(r))
+            fieldheaders = readers.read_field_headers(epyresource=r, fieldnames=fieldnames)
+            zlevels = readers.read_z_dim(r, levels=selected_levels)
+            vertical_details = readers.read_vertical_attrs(r, levels=selected_levels)
+            geometry_coords = _window_coords(geometry_coords, window)
+            if add_latlon_coords:
+                lons, lats = latlon_arrays(geometry_coords=geometry_coords,
+                                           filename=filenames[0],
+                                           epyresource=r,
+                                           window=window)
+        finally:
+            r.close()
+
+    # --- Variables ---
+    H2D_fieldnameset, ATM3D_fieldnameset = triage_2d_and_3d_fields(fieldnames=fieldnames)
+    if selected_levels is not None:
+        ATM3D_fieldnameset = select_3d_levels(d3_fields=ATM3D_fieldnameset,
+                                              levels=selected_levels)
+
+    dataset_variables = {}
+    for fieldname in H2D_fieldnameset.keys():
+        header = fieldheaders[fieldname]
+        if header['structure'] != 'H2D':
+            logging.warning(f"Field '{fieldname}' is not a H2D field and will be skipped.")
+            continue
+        attrs = readers.read_h2d_header_attrs(header)
+        dataset_variables[formatters.fmt_variablename(fieldname)] = _multifile_variable(
+            filegrid=filegrid,
+            headers=[header],
+            fieldname=fieldname,
+            attrs=attrs,
+            is3d=False,
+            window=window,
+            spectral_transform=spectral_transform,
+            create_base_dim=create_base_dimension,
+            namesettings=namesettings,
+            unitsettings=unitsettings)
+
+    for basename, crossections in ATM3D_fieldnameset.items():
+        headers = [fieldheaders[name] for name in crossections]
+        attrs = readers.read_3d_header_attrs(headers)
+        dataset_variables[formatters.fmt_variablename(basename)] = _multifile_variable(
+            filegrid=filegrid,
+            headers=headers,
+            fieldname=basename,
+            attrs=attrs,
+            is3d=True,
+            window=window,
+            spectral_transform=spectral_transform,
+            create_base_dim=create_base_dimension,
+            namesettings=namesettings,
+            unitsettings=unitsettings)
+
+    # --- Coordinates ---
+    dataset_coords = {
+        namesettings['coordnames']['zdim']: zlevels,
+        namesettings['coordnames']['xdim']: geometry_coords['x'],
+        namesettings['coordnames']['ydim']: geometry_coords['y'],
+        namesettings['coordnames']['validtime']: formatters.fmt_validtime_variable(
+            validtime=validdates,
+            dimname=namesettings['coordnames']['validtime']),
+    }
+    if create_base_dimension:
+        dataset_coords[namesettings['coordnames']['basetime']] = formatters.fmt_basedate_variable(
+            basedate=basedates,
+            dimname=namesettings['coordnames']['basetime'])
+    if add_latlon_coords:
+        dataset_coords[namesettings['coordnames']['latcoord']] = formatters.fmt_lat_variable(lats)
+        dataset_coords[namesettings['coordnames']['loncoord']] = formatters.fmt_lon_variable(lons)
+
+    # --- Attributes ---
+    dataset_attrs = {'proj_crs': geometry_coords['proj_crs']}
+    dataset_attrs.update(formatters.fmt_dict_for_attrs(vertical_details))
+
+    ds = xr.Dataset(data_vars={**dataset_variables},
+                    coords={**dataset_coords},
+                    attrs=dataset_attrs)
+
+    #drop the artificial vertical dimension
+    if ds[namesettings['coordnames']['zdim']].shape == (1,):
+        ds.attrs['zdim_detected'] = 'False'
+        ds = ds.isel({namesettings['coordnames']['zdim']: 0})
+    else:
+        ds.attrs['zdim_detected'] = 'True'
+    return ds
+
+
+def expand_paths(paths) -> list:
+    """
+    Get the list of FA files from a glob expression or a list of paths.
+
+    Parameters
+    ----------
+    paths : str, Path or list
+        Glob expression of the FA files, or a list of paths.
+
+    Returns
+    -------
+    list of str
+        The paths of the FA files.
+    """
+    if isinstance(paths, (str, Path)):
+        filenames = sorted(glob.glob(str(paths)))
+    else:
+        filenames = [str(path) for path in paths]
+    if not bool(filenames):
+        raise ValueError(f'No FA files found for {paths}.')
+    return filenames
+
+
+def _build_filegrid(filenames: list, entries: list, create_base_dimension: bool) -> tuple:
+    # Arrange the files on the (base time, valid time) grid
+    validdates = [pd.Timestamp(entry['validdate']) for entry in entries]
+    if create_base_dimension:
+        basedates = [pd.Timestamp(entry['basedate']) for entry in entries]
+    else:
+        basedates = [None] * len(entries)
+    base_axis = sorted(set(basedates), key=lambda t: (t is not None, t))
+    valid_axis = sorted(set(validdates))
+
+    filegrid = np.full((len(base_axis), len(valid_axis)), None, dtype=object)
+    base_index = {basedate: i for i, basedate in enumerate(base_axis)}
+    valid_index = {validdate: i for i, validdate in enumerate(valid_axis)}
+    for filename, basedate, validdate in zip(filenames, basedates, validdates):
+        cell = (base_index[basedate], valid_index[validdate])
+        if filegrid[cell] is not None:
+            raise ValueError(f'{filename} and {filegrid[cell]} have the same validity ({basedate}, {validdate}).')
+        filegrid[cell] = filename
+    return filegrid, base_axis, valid_axis
+
+
+def _multifile_variable(filegrid, headers: list, fieldname: str, attrs: dict, is3d: bool,
+                        window, spectral_transform: bool, create_base_dim: bool,
+                        namesettings: dict, unitsettings: dict) -> xr.Variable:
+    # Lazy variable of an (H2D or 3D) field over all the files of the grid
+    raw_spectral = headers[0]['spectral'] and not spectral_transform
+    fielddim_order = [namesettings['coordnames']['basetime'],
+                      namesettings['coordnames']['validtime']]
+    fieldshape = tuple(filegrid.shape)
+    if is3d:
+        fielddim_order.append(namesettings['coordnames']['zdim'])
+        fieldshape = (*fieldshape, len(headers))
+    fielddim_order.extend(_horizontal_dims(namesettings, raw_spectral))
+    fieldshape = (*fieldshape, *_header_shape(headers[0], window, raw_spectral))
+
+    fieldata = lazy_multifile_data(filenames=filegrid,
+                                   fieldnames=[header['fid']['FA'] for header in headers],
+                                   shape=fieldshape,
+                                   dtype=headers[0]['dtype'],
+                                   window=window,
+                                   spectral_transform=spectral_transform)
+
+    attrs.update({'short_name': fieldname,
+                  'units': unitsettings.get(fieldname, 'Unknown')})
+    #one chunk per file and field (and per level), read by its own task
+    encoding = {'preferred_chunks': preferred_chunks(dims=fielddim_order,
+                                                     shape=fieldshape,
+                                                     field_dims=_horizontal_dims(namesettings, raw_spectral))}
+    var = xr.Variable(dims=fielddim_order,
+                      data=fieldata,
+                      attrs=formatters.fmt_dict_for_attrs(attrs),
+                      encoding=encoding)
+    if not create_base_dim:
+        var = var.isel({namesettings['coordnames']['basetime']: 0})
+    return var
@@ -7,6 +7,7 @@ defaultsettings = {
         'ydim': 'y',
         'latcoord': 'lat',
         'loncoord': 'lon',
+        'spectraldim': 'spec', #raw spectral coefficients
 
         #vertical
         'zdim': 'z',
@@ -27,6 +28,10 @@ default_units = {
     'CLSTEMPERATURE': "kelvin",
 }
 
+#output dtype per variable (FA fieldname, or base name of 3D fields),
+# the fields that are not listed keep the dtype of the dtype argument
+default_dtypes = {}
+
 #the blackfields are always skipped
 default_blackfields = [
     "SFX.STORAGE_TYPE",
@@ -3,6 +3,7 @@ import sys
 from pathlib import Path
 
 
+import numpy as np
 import xarray as xr
 
 
@@ -82,4 +83,527 @@ class TestPGDData:
          assert len(ds.variables) > 30 #equal test might be too strickt?
          assert 'proj_crs' in ds.attrs.keys()
          assert ds.attrs['PGD_detected'] == 'True'
-         assert ds.attrs['zdim_detected'] == 'False'
\ No newline at end of file
+         assert ds.attrs['zdim_detected'] == 'False'
+
+     def test_guess_can_open(self):
+         assert FAEngine().guess_can_open(pgdfile)
+         assert FAEngine().guess_can_open(str(pgdfile))
+         assert not FAEngine().guess_can_open(Path(__file__))
+         assert not FAEngine().guess_can_open(testdatafolder.joinpath('missing_file'))
+
+     def test_lazy_load(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine)
+         ds_lazy = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'lazy_load': True})
+
+         assert list(ds_lazy.data_vars) == list(ds.data_vars)
+         assert ds_lazy.attrs == ds.attrs
+         for var in ds.data_vars:
+            xr.testing.assert_identical(ds_lazy[var].load(), ds[var])
+
+     def test_dask_chunks(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     chunks={},
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*',
+                                     'lazy_load': True})
+         ds_eager = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*'})
+
+         #one chunk per field
+         assert ds['SURFZ0.FOIS.G'].chunks == ((80,), (60,))
+         xr.testing.assert_allclose(ds.compute(), ds_eager)
+
+     def test_geometry_cache(self):
+         faengine.geometry_cache.clear()
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine)
+         ds2 = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine)
+
+         assert faengine.geometry_cache.info()['misses'] == 1
+         assert faengine.geometry_cache.info()['hits'] == 1
+         #the reopened file shares the cached coordinates, they are not recomputed
+         for coord in ['x', 'y', 'lat', 'lon']:
+            assert np.shares_memory(ds[coord].values, ds2[coord].values)
+         xr.testing.assert_identical(ds['lat'], ds2['lat'])
+         assert ds.attrs['proj_crs'] == ds2.attrs['proj_crs']
+
+     def test_field_cache(self):
+         faengine.field_cache.clear()
+         faengine.field_cache.max_bytes = 10 * 1024 * 1024
+         try:
+            ds = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0*'})
+            ds2 = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0.FOIS.G'})
+         finally:
+            faengine.field_cache.max_bytes = 0
+         assert faengine.field_cache.info()['misses'] == 3
+         assert faengine.field_cache.info()['hits'] == 1
+         #the cached field is not decoded again, the reopened dataset shares it
+         assert np.shares_memory(ds['SURFZ0.FOIS.G'].values, ds2['SURFZ0.FOIS.G'].values)
+         xr.testing.assert_identical(ds['SURFZ0.FOIS.G'], ds2['SURFZ0.FOIS.G'])
+         faengine.field_cache.clear()
+
+         #a budget of one field keeps the last decoded field (LRU eviction)
+         faengine.field_cache.max_bytes = 80 * 60 * 8
+         try:
+            ds = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0*'})
+            info = faengine.field_cache.info()
+            assert (info['misses'], info['evictions'], info['size']) == (3, 2, 1)
+            ds2 = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': list(ds.data_vars)[-1]})
+         finally:
+            faengine.field_cache.max_bytes = 0
+         assert faengine.field_cache.info()['hits'] == 1
+         faengine.field_cache.clear()
+
+     def test_lazy_latlon(self, tmp_path):
+         faengine.geometry_cache.clear()
+         faengine.geometry_cache.cache_dir = tmp_path
+         try:
+            ds = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0.FOIS.G',
+                                        'add_latlon_coords': 'lazy'})
+            #nothing is projected (nor cached) when opening
+            assert not any(tmp_path.iterdir())
+            ds_eager = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0.FOIS.G'})
+            xr.testing.assert_identical(ds['lat'], ds_eager['lat'])
+            assert len(list(tmp_path.glob('latlon_*.npz'))) == 1
+
+            #the grids are reused from disk in a new session
+            faengine.geometry_cache.clear()
+            xr.open_dataset(filename_or_obj=pgdfile, engine=FAEngine)
+            assert faengine.geometry_cache.info()['disk_hits'] == 1
+         finally:
+            faengine.geometry_cache.cache_dir = None
+            faengine.geometry_cache.clear()
+
+     def test_subdomain(self, monkeypatch):
+         from faengine.backend import arrays
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine)
+         ds_ci = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'drop_extension_zone': True})
+         assert dict(ds_ci.sizes) == {'y': 69, 'x': 49}
+         xr.testing.assert_identical(ds_ci, ds.isel(y=slice(0, 69), x=slice(0, 49)))
+
+         #count the lazy reads, and the shape of the data that is read
+         reads = []
+         read_fields = arrays.read_fields
+         def counting_read_fields(**kwargs):
+            data = read_fields(**kwargs)
+            reads.append(data.shape)
+            return data
+         monkeypatch.setattr(arrays, 'read_fields', counting_read_fields)
+
+         ds_window = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'index_window': {'x': (10, 20), 'y': (5, 30)},
+                                     'lazy_load': True})
+         assert dict(ds_window.sizes) == {'y': 25, 'x': 10}
+         np.testing.assert_array_equal(ds_window['x'].values, ds['x'].values[10:20])
+         np.testing.assert_array_equal(ds_window['y'].values, ds['y'].values[5:30])
+         #nothing is read before loading, then only the window of each field
+         assert reads == []
+         ds_window['SURFZ0.FOIS.G'].load()
+         assert reads == [(25, 10)]
+         xr.testing.assert_identical(ds_window.load(), ds.isel(y=slice(5, 30), x=slice(10, 20)))
+
+         ds_bbox = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'bbox': (4.5, 51.5, 5.0, 52.0)})
+         inside = ((ds_bbox['lon'] >= 4.5) & (ds_bbox['lon'] <= 5.0) &
+                   (ds_bbox['lat'] >= 51.5) & (ds_bbox['lat'] <= 52.0))
+         assert bool(inside.any('x').all()) & bool(inside.any('y').all())
+
+     def test_parallel_decoding(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine)
+         ds_parallel = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'n_workers': 2})
+
+         assert list(ds_parallel.data_vars) == list(ds.data_vars)
+         xr.testing.assert_identical(ds_parallel, ds)
+
+     def test_parallel_without_main_guard(self, tmp_path):
+         import subprocess
+         #the spawned workers can not start, the fields are decoded serially
+         script = tmp_path / 'noguard.py'
+         script.write_text(f"import sys\n"
+                           f"sys.path.insert(1, {str(libfolder)!r})\n"
+                           f"import xarray as xr\n"
+                           f"from faengine import FAEngine\n"
+                           f"ds = xr.open_dataset({str(pgdfile)!r}, engine=FAEngine,\n"
+                           f"                     whitefield_glob='SURFZ0.FOIS.G', n_workers=2)\n"
+                           f"print('opened', list(ds.data_vars), flush=True)\n")
+         result = subprocess.run([sys.executable, str(script)], cwd=tmp_path,
+                                 capture_output=True, text=True, timeout=300)
+         assert "opened ['SURFZ0.FOIS.G']" in result.stdout
+         assert 'decoded serially' in result.stdout + result.stderr
+
+     def test_spectral_transform(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SPECSURFGEOPOTEN'})
+         ds_raw = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SPECSURFGEOPOTEN',
+                                     'spectral_transform': False,
+                                     'lazy_load': True})
+
+         assert ds['SPECSURFGEOPOTEN'].dims == ('y', 'x')
+         assert ds_raw['SPECSURFGEOPOTEN'].dims == ('spec',)
+         assert ds_raw['SPECSURFGEOPOTEN'].values.shape == ds_raw['SPECSURFGEOPOTEN'].shape
+
+         #the same coefficients and transform as Epygram
+         from faengine.backend.arrays import open_fa_resource
+         r = open_fa_resource(pgdfile)
+         r.open()
+         field = r.readfield('SPECSURFGEOPOTEN')
+         np.testing.assert_array_equal(ds_raw['SPECSURFGEOPOTEN'].values, field.data)
+         field.sp2gp()
+         r.close()
+         np.testing.assert_allclose(ds['SPECSURFGEOPOTEN'].values, field.data)
+
+     def test_raw_field(self):
+         from faengine.backend.arrays import open_fa_resource
+         from faengine.backend.readers import read_raw_field
+         r = open_fa_resource(pgdfile)
+         r.open()
+         data = r.readfield('SURFZ0.FOIS.G').data
+         r.close()
+
+         #uncompressed field: memory-mapped view of the file
+         raw = read_raw_field(pgdfile, 'SURFZ0.FOIS.G', window=(slice(10, 20), slice(5, 15)))
+         assert not raw.flags.writeable
+         np.testing.assert_array_equal(raw, data[10:20, 5:15])
+         #compressed and spectral fields are read by Epygram
+         assert read_raw_field(pgdfile, 'SURFIND.TERREMER') is None
+         assert read_raw_field(pgdfile, 'SPECSURFGEOPOTEN') is None
+
+         #an eager open copies it into memory, native and writeable like the decoded fields
+         for kwargs in [{}, {'n_workers': 1}]:
+            ds = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        whitefield_glob=['SURFZ0.FOIS.G', 'SURFIND.TERREMER'],
+                        **kwargs)
+            for var in ds.data_vars.values():
+               assert var.dtype == np.float64
+               assert var.values.flags.writeable
+            np.testing.assert_array_equal(ds['SURFZ0.FOIS.G'].values, data)
+         ds = xr.open_dataset(filename_or_obj=pgdfile, engine=FAEngine,
+                     whitefield_glob='SURFZ0.FOIS.G', dtype='float32')
+         assert ds['SURFZ0.FOIS.G'].dtype == np.float32
+
+     def test_raw_masked_field(self, tmp_path):
+         import shutil
+         from faengine.backend.epygram_env import load_epygram
+         from faengine.backend.readers import read_raw_field
+         filename = tmp_path / 'masked.fa'
+         shutil.copy(pgdfile, filename)
+         r = load_epygram().formats.resource(str(filename), 'a')
+         field = r.readfield('SURFZ0.FOIS.G')
+         field.setdata(np.ma.masked_where(field.data > 1., field.data))
+         field.fid['FA'] = 'SURFZ0MASK.TEST'
+         r.writefield(field, compression={'KNGRIB': 0})
+         r.close()
+
+         #the missing values of an uncompressed field are read as Epygram does
+         r = load_epygram().formats.resource(str(filename), 'r')
+         data = r.readfield('SURFZ0MASK.TEST').getdata()
+         r.close()
+         np.testing.assert_array_equal(read_raw_field(filename, 'SURFZ0MASK.TEST'), data)
+
+     def test_profile(self):
+         reports = []
+         faengine.add_profile_hook(reports.append)
+         try:
+            ds = xr.open_dataset(filename_or_obj=pgdfile,
+                        engine=FAEngine,
+                        backend_kwargs={'whitefield_glob': 'SURFZ0*',
+                                        'profile': True})
+         finally:
+            faengine.remove_profile_hook(reports.append)
+
+         report = ds.encoding['faengine_profile']
+         assert reports == [report]
+         assert report['n_fields'] == 3
+         assert report['stages']['readfield']['calls'] == 3
+         assert report['bytes_decoded'] == sum(ds[name].nbytes for name in ds.data_vars)
+
+         #only the transform is timed as sp2gp, the parallel decoding as decode
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': ['SURFZ0*', 'SPECSURFGEOPOTEN'],
+                                     'profile': True})
+         stages = ds.encoding['faengine_profile']['stages']
+         assert stages['sp2gp']['calls'] == 1
+         assert stages['to_variable']['calls'] == 4
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*',
+                                     'n_workers': 2,
+                                     'profile': True})
+         assert ds.encoding['faengine_profile']['stages']['decode']['calls'] == 1
+
+     def test_output_dtype(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*'})
+         ds_small = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*',
+                                     'dtype': 'float32',
+                                     'custom_dtype_settings': {'SURFZ0.FOIS.G': 'int16'}})
+
+         assert ds_small['SURFZ0REL.FOIS.G'].dtype == np.float32
+         #packed in int16, unpacked (within half a packing step) by xarray
+         packed = ds_small['SURFZ0.FOIS.G']
+         assert packed.encoding['dtype'] == np.int16
+         error = np.nanmax(np.abs(packed.values - ds['SURFZ0.FOIS.G'].values))
+         assert error <= 0.5 * packed.encoding['scale_factor'] + 1e-6
+
+         #an integer output dtype does not apply to the lat/lon coordinates
+         ds_int = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0.FOIS.G',
+                                     'dtype': 'int16'})
+         assert ds_int['lat'].dtype == ds['lat'].dtype
+         xr.testing.assert_identical(ds_int['lat'], ds['lat'])
+         xr.testing.assert_identical(ds_int['lon'], ds['lon'])
+
+     def test_inventory(self, tmp_path):
+         inventory = faengine.FieldInventory(tmp_path / 'inventory.sqlite')
+         kwargs = {'whitefield_glob': ['SURF*'], 'blackfield_glob': '*G'}
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs=kwargs)
+         for _ in range(2):
+             ds_inv = xr.open_dataset(filename_or_obj=pgdfile,
+                         engine=FAEngine,
+                         backend_kwargs={**kwargs, 'inventory': inventory})
+             xr.testing.assert_identical(ds_inv, ds)
+
+         assert inventory.info() == {'hits': 1, 'misses': 1, 'size': 1}
+         entry = inventory.get(pgdfile)
+         assert len(entry['fieldnames']) == 40
+         assert entry['d3_fields'] == {}
+
+     def test_open_fa_mfdataset(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURF*'})
+         ds_mf = faengine.open_fa_mfdataset([pgdfile], whitefield_glob='SURF*')
+
+         assert ds_mf['SURFZ0.FOIS.G'].dims == ('t_base', 't', 'y', 'x')
+         assert list(ds_mf.data_vars) == list(ds.data_vars)
+         xr.testing.assert_equal(ds_mf['SURFZ0.FOIS.G'].isel(t_base=0, t=0).drop_vars(['t_base', 't']),
+                                 ds['SURFZ0.FOIS.G'].drop_vars(['t_base', 't']))
+
+         #files with the same validity can not be combined
+         with pytest.raises(ValueError):
+             faengine.open_fa_mfdataset([pgdfile, pgdfile])
+
+         #custom settings only apply to their own open
+         ds_units = faengine.open_fa_mfdataset([pgdfile], whitefield_glob='SURFZ0.FOIS.G',
+                                               custom_unit_settings={'SURFZ0.FOIS.G': 'm'})
+         assert ds_units['SURFZ0.FOIS.G'].attrs['units'] == 'm'
+         assert 'SURFZ0.FOIS.G' not in faengine.settings.default_units
+
+         #partial custom coordinate names, and a subdomain of the shared coordinates
+         ds_names = faengine.open_fa_mfdataset([pgdfile], whitefield_glob='SURFZ0.FOIS.G',
+                                               index_window={'x': (10, 20), 'y': (5, 30)},
+                                               custom_name_settings={'coordnames': {'xdim': 'rlon'}})
+         assert ds_names['SURFZ0.FOIS.G'].dims == ('t_base', 't', 'y', 'rlon')
+         np.testing.assert_array_equal(ds_names['rlon'].values, ds['x'].values[10:20])
+         np.testing.assert_array_equal(ds_names['lat'].values, ds['lat'].values[5:30, 10:20])
+
+     def test_multifile_array(self):
+         from faengine.backend.arrays import FAMultiFileArray
+         from xarray.core.indexing import BasicIndexer
+         filegrid = np.array([[str(pgdfile), None]], dtype=object)
+         array = FAMultiFileArray(filenames=filegrid,
+                                  fieldnames=['SURFZ0.FOIS.G'],
+                                  shape=(1, 2, 80, 60))
+         data = array[BasicIndexer((0, slice(None), slice(10, 12), 5))]
+         assert data.shape == (2, 2)
+         assert np.isfinite(data[0]).all()
+         assert np.isnan(data[1]).all()
+
+     def test_iter_fields(self):
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURF*'})
+         names = []
+         for field in faengine.iter_fields(pgdfile, whitefield_glob='SURF*'):
+             xr.testing.assert_identical(field, ds[field.name])
+             names.append(field.name)
+         assert names == list(ds.data_vars)
+
+         datasets = list(faengine.iter_timesteps([pgdfile], whitefield_glob='SURF*'))
+         assert len(datasets) == 1
+         xr.testing.assert_identical(datasets[0], ds)
+
+     def test_convert_zarr(self, tmp_path):
+         pytest.importorskip('zarr')
+         from faengine.convert import convert
+         store = tmp_path / 'pgd.zarr'
+         stats = convert([pgdfile], store, chunks={'t': 24, 'y': 40, 'x': 30},
+                         whitefield_glob='SURFZ0*')
+         assert stats['files'] == 1
+         assert stats['fields'] == 3
+
+         #converted files are skipped (resume)
+         stats = convert([pgdfile], store, whitefield_glob='SURFZ0*')
+         assert (stats['files'], stats['skipped']) == (0, 1)
+
+         ds = xr.open_dataset(filename_or_obj=pgdfile,
+                     engine=FAEngine,
+                     backend_kwargs={'whitefield_glob': 'SURFZ0*'})
+         ds_zarr = xr.open_zarr(store)
+         assert ds_zarr['SURFZ0.FOIS.G'].dims == ('t', 'y', 'x')
+         assert ds_zarr['SURFZ0.FOIS.G'].encoding['chunks'] == (24, 40, 30)
+         xr.testing.assert_allclose(ds_zarr['SURFZ0.FOIS.G'].isel(t=0).drop_vars(['t', 't_base']),
+                                    ds['SURFZ0.FOIS.G'].drop_vars(['t', 't_base']))
+
+         #custom coordinate names only need the names that differ from the defaults
+         store = tmp_path / 'pgd_names.zarr'
+         stats = convert([pgdfile], store, whitefield_glob='SURFZ0*',
+                         custom_name_settings={'coordnames': {'ydim': 'rlat'}})
+         assert stats['fields'] == 3
+         assert xr.open_zarr(store)['SURFZ0.FOIS.G'].dims == ('t', 'rlat', 'x')
+         assert faengine.settings.defaultsettings['coordnames']['ydim'] == 'y'
+
+
+
+@pytest.fixture(scope='module')
+def d3file(tmp_path_factory):
+   """A small FA file with a 3D field (4 hybrid levels) on the PGD geometry."""
+   import copy
+   from faengine.backend.epygram_env import load_epygram
+   epygram = load_epygram()
+   filename = tmp_path_factory.mktemp('d3') / 'd3.fa'
+   pgd = epygram.formats.resource(str(pgdfile), 'r')
+   field = pgd.readfield('SURFZ0.FOIS.G')
+   field.geometry.vcoordinate.grid = {
+      'gridlevels': tuple((i + 1, {'Ai': 100. * i, 'Bi': i / 4.}) for i in range(5)),
+      'ABgrid_position': 'flux'}
+   r = epygram.formats.resource(str(filename), 'w', fmt='FA',
+                                geometry=field.geometry, validity=pgd.validity,
+                                cdiden=pgd.cdiden, processtype=pgd.processtype)
+   pgd.close()
+   for level in range(1, 5):
+      crossection = copy.deepcopy(field)
+      crossection.fid['FA'] = f'S{level:03d}TEMPERATURE'
+      crossection.geometry.vcoordinate.levels = [level]
+      crossection.setdata(field.getdata() + level)
+      r.writefield(crossection, compression={'KNGRIB': 0})
+   r.close()
+   return filename
+
+class TestD3Data:
+   def test_open_file(self, d3file):
+      from faengine.backend.epygram_env import load_epygram
+      ds = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine)
+      assert ds['TEMPERATURE'].dims == ('z', 'y', 'x')
+      assert list(ds['z'].values) == [1, 2, 3, 4]
+
+      #the 3D field is read through the CombineLevels index, level by level
+      r = load_epygram().formats.resource(str(d3file), 'r')
+      for level in range(1, 5):
+         data = r.readfield(f'S{level:03d}TEMPERATURE').getdata()
+         np.testing.assert_array_equal(ds['TEMPERATURE'].sel(z=level).values, data)
+      r.close()
+
+   def test_combine_levels_closed(self, d3file, monkeypatch):
+      from faengine.engine import CombineLevelsIndex
+      closed = []
+      close = CombineLevelsIndex.close
+      def counting_close(self):
+         closed.append(True)
+         close(self)
+      monkeypatch.setattr(CombineLevelsIndex, 'close', counting_close)
+      #the CombineLevels resource is closed, also when reading a 3D field fails
+      monkeypatch.setattr(CombineLevelsIndex, 'readfield',
+                          lambda self, handgrip, getdata=True: 1 / 0)
+      with pytest.raises(ZeroDivisionError):
+         xr.open_dataset(filename_or_obj=d3file,
+                     engine=FAEngine)
+      assert closed == [True]
+
+   def test_levels(self, d3file):
+      ds = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine)
+      ds_levels = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine,
+                  backend_kwargs={'levels': [2, 3]})
+      assert list(ds_levels['z'].values) == [2, 3]
+      xr.testing.assert_equal(ds_levels['TEMPERATURE'], ds['TEMPERATURE'].sel(z=[2, 3]))
+
+      #the hybrid coefficients of the half levels around the selected levels
+      assert ds_levels.attrs['Nlevels'] == 2
+      assert list(ds_levels.attrs['Ai_coef']) == [100., 200., 300.]
+      assert list(ds_levels.attrs['Bi_coef']) == [0.25, 0.5, 0.75]
+
+      #a single level is selected, its z dimension is dropped like that of a 2D file
+      for lazy_load in (False, True):
+         ds_lowest = xr.open_dataset(filename_or_obj=d3file,
+                     engine=FAEngine,
+                     backend_kwargs={'levels': 'lowest 1', 'lazy_load': lazy_load})
+         assert int(ds_lowest['z']) == 4
+         assert ds_lowest['TEMPERATURE'].dims == ('y', 'x')
+         xr.testing.assert_equal(ds_lowest['TEMPERATURE'].load(), ds['TEMPERATURE'].sel(z=4))
+
+   def test_parallel_decoding(self, d3file):
+      for backend_kwargs in ({}, {'levels': [1, 3]}):
+         ds = xr.open_dataset(filename_or_obj=d3file,
+                     engine=FAEngine,
+                     backend_kwargs=backend_kwargs)
+         ds_parallel = xr.open_dataset(filename_or_obj=d3file,
+                     engine=FAEngine,
+                     backend_kwargs={**backend_kwargs, 'n_workers': 2})
+         xr.testing.assert_identical(ds_parallel, ds)
+
+   def test_dask_chunks(self, d3file):
+      pytest.importorskip('dask')
+      ds = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine)
+      ds_chunked = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine,
+                  chunks={},
+                  backend_kwargs={'lazy_load': True})
+      #one chunk per level (crossection)
+      assert ds_chunked['TEMPERATURE'].encoding['preferred_chunks'] == {'z': 1, 'y': 80, 'x': 60}
+      assert ds_chunked['TEMPERATURE'].chunks == ((1, 1, 1, 1), (80,), (60,))
+      xr.testing.assert_identical(ds_chunked.load(), ds)
+
+      ds_lazy = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine,
+                  backend_kwargs={'lazy_load': True})
+      xr.testing.assert_equal(ds_lazy['TEMPERATURE'].isel(z=[1, 3], y=slice(10, 20)),
+                              ds['TEMPERATURE'].isel(z=[1, 3], y=slice(10, 20)))
+
+   def test_open_fa_mfdataset(self, d3file):
+      ds = xr.open_dataset(filename_or_obj=d3file,
+                  engine=FAEngine)
+      ds_mf = faengine.open_fa_mfdataset([d3file])
+      assert ds_mf['TEMPERATURE'].dims == ('t_base', 't', 'z', 'y', 'x')
+      #only the selected levels are read from each file
+      xr.testing.assert_equal(ds_mf['TEMPERATURE'].isel(t_base=0, t=0, z=[0, 2]).drop_vars(['t_base', 't']),
+                              ds['TEMPERATURE'].isel(z=[0, 2]).drop_vars(['t_base', 't']))
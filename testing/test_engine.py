@@ -0,0 +1,123 @@
+import pytest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+
+
+libfolder = Path(str(Path(__file__).resolve())).parent.parent
+
+# point to current version of the faengine
+sys.path.insert(1, str(libfolder))
+from faengine.engine import (find_target_fields,
+                             resolve_levels,
+                             select_3d_levels,
+                             triage_2d_and_3d_fields)
+from faengine.backend.arrays import preferred_chunks, select_levels, unmask_data
+
+
+class TestLevelSelection:
+   available_levels = np.arange(1, 91)
+
+   def test_resolve_levels(self):
+      assert resolve_levels(None, self.available_levels) is None
+      assert resolve_levels('lowest 3', self.available_levels) == [88, 89, 90]
+      assert resolve_levels('lowest3', self.available_levels) == [88, 89, 90]
+      assert resolve_levels(slice(0, 2), self.available_levels) == [1, 2]
+      assert resolve_levels([5, 3], self.available_levels) == [3, 5]
+      assert resolve_levels(7, self.available_levels) == [7]
+
+      with pytest.raises(ValueError):
+         resolve_levels([95], self.available_levels)
+      with pytest.raises(ValueError):
+         resolve_levels('highest 3', self.available_levels)
+
+   def test_select_3d_levels(self):
+      fieldnames = [f'S{level:03d}TKE' for level in self.available_levels]
+      fieldnames.append('CLSTEMPERATURE')
+      _, d3_fields = triage_2d_and_3d_fields(fieldnames=fieldnames)
+
+      selected = select_3d_levels(d3_fields=d3_fields, levels=[89, 90])
+      assert selected == {'TKE': ['S089TKE', 'S090TKE']}
+
+
+class TestTriage:
+   def test_triage_2d_and_3d_fields(self):
+      fieldnames = ['S002TKE', 'CLSTEMPERATURE', 'S001TKE', 'S002TKE.X',
+                    'SURFTEMPERATURE', 'S010TKE', 'S001TKE.X']
+      d2_fields, d3_fields = triage_2d_and_3d_fields(fieldnames=fieldnames)
+
+      assert d2_fields == {'CLSTEMPERATURE': 'CLSTEMPERATURE',
+                           'SURFTEMPERATURE': 'SURFTEMPERATURE'}
+      assert d3_fields == {'TKE': ['S001TKE', 'S002TKE', 'S010TKE'],
+                           'TKE.X': ['S001TKE.X', 'S002TKE.X']}
+
+   def test_find_target_fields(self):
+      fieldnames = ['S001TKE', 'S002TKE', 'CLSTEMPERATURE', 'SURFTEMPERATURE',
+                    'SURFZ0.FOIS.G', 'SFX.BUGFIX']
+      kwargs = {'epyresource': None, 'fieldlist': fieldnames}
+
+      assert find_target_fields(whitefield_glob='*', blackfield_glob=['S0??TKE', 'CLS*'],
+                                drop_variables='SURFTEMPERATURE',
+                                **kwargs) == ['SURFZ0.FOIS.G']
+      assert find_target_fields(whitefield_glob=['S00[12]TKE', 'SURF*.G'], blackfield_glob='',
+                                drop_variables=None,
+                                **kwargs) == ['S001TKE', 'S002TKE', 'SURFZ0.FOIS.G']
+      #'.' is not a wildcard
+      assert find_target_fields(whitefield_glob='SURFZ0?FOIS.G', blackfield_glob=None,
+                                drop_variables=None, **kwargs) == ['SURFZ0.FOIS.G']
+      with pytest.raises(ValueError):
+         find_target_fields(whitefield_glob=['NOT*', 'FOUND'], blackfield_glob='',
+                            drop_variables=None, **kwargs)
+
+
+class TestUnmask:
+   def test_unmask_data(self):
+      data = np.ma.masked_array(np.arange(6, dtype=np.float64).reshape(2, 3),
+                                mask=[[False, True, False], [False, False, True]])
+      values = unmask_data(data)
+      assert not np.ma.isMaskedArray(values)
+      #filled in place, no copy of the data
+      assert np.shares_memory(values, data)
+      assert np.isnan(values).sum() == 2
+
+      #all False mask: the data is returned as is
+      data = np.ma.masked_array(np.ones(4), mask=np.zeros(4, dtype=bool))
+      assert np.shares_memory(unmask_data(data), data)
+
+      #integer data with a CF _FillValue
+      data = np.ma.masked_array(np.arange(3, dtype=np.int16), mask=[True, False, False])
+      assert unmask_data(data, fill_value=-32768).tolist() == [-32768, 1, 2]
+
+
+class TestChunks:
+   fieldnames = ['S001TKE', 'S002TKE', 'S003TKE']
+   shape = (1, 1, 3, 80, 60)
+
+   def test_select_levels(self):
+      #one level: only its crossection is read, the z axis is dropped by the key
+      fieldnames, shape, key = select_levels(self.fieldnames, self.shape,
+                                             (0, 0, 1, slice(None), slice(None)))
+      assert fieldnames == ['S002TKE']
+      assert shape == (1, 1, 1, 80, 60)
+      assert key == (0, 0, 0, slice(None), slice(None))
+
+      fieldnames, shape, _ = select_levels(self.fieldnames, self.shape,
+                                           (0, 0, slice(1, 3), slice(None), slice(None)))
+      assert fieldnames == ['S002TKE', 'S003TKE']
+      assert shape == (1, 1, 2, 80, 60)
+
+      #as many levels as gridpoints along y: the z axis is the one before y
+      fieldnames = [f'S{level:03d}TKE' for level in range(1, 81)]
+      selected, shape, key = select_levels(fieldnames, (1, 1, 80, 80, 60),
+                                           (0, 0, slice(0, 2), 5, slice(None)))
+      assert selected == fieldnames[:2]
+      assert shape == (1, 1, 2, 80, 60)
+      assert key == (0, 0, slice(None), 5, slice(None))
+
+   def test_preferred_chunks(self):
+      chunks = preferred_chunks(dims=['t_base', 't', 'z', 'y', 'x'], shape=self.shape,
+                                field_dims=['y', 'x'])
+      assert chunks == {'t_base': 1, 't': 1, 'z': 1, 'y': 80, 'x': 60}
+